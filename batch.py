@@ -0,0 +1,37 @@
+""" Bulk disk operations.
+
+    The items of a batch run on a bounded thread pool inside one task,
+    so deploying a pool of disks costs one broker round trip and the
+    qemu-img processes run in parallel. Every item has its own result,
+    and a failed item does not fail the others.
+"""
+import os
+import logging
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+batch_workers = int(os.getenv("BATCH_WORKERS", 8))
+
+
+def run_batch(function, items, workers=None):
+    """ Call function(item) for each item, return a list of
+        {'name', 'status', 'result' or 'error'} dicts in item order.
+    """
+    def run(item):
+        name = item.get('name') if isinstance(item, dict) else None
+        try:
+            return {'name': name, 'status': 'ok', 'result': function(item)}
+        except Exception as e:
+            logger.exception("Batch item %s failed.", name)
+            return {'name': name, 'status': 'error', 'error': str(e)}
+
+    workers = min(workers or batch_workers, len(items))
+    if workers <= 1:
+        return [run(item) for item in items]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(run, items)
+    finally:
+        pool.close()
+        pool.join()
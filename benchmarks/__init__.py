@@ -0,0 +1,7 @@
+""" Benchmarks of the storage driver's hot paths.
+
+    Run from the repository root:
+
+        python -m benchmarks.run --save-baseline baseline.json
+        python -m benchmarks.run --compare baseline.json
+"""
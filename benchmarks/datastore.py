@@ -0,0 +1,91 @@
+""" Synthetic datastores and download payloads. """
+import os
+import bz2
+import gzip
+import struct
+import zipfile
+
+QCOW2_HEADER_LENGTH = 104
+
+
+def qcow2_header(size, backing_file=None):
+    """Return a minimal qcow2 v3 header, optionally with a backing file."""
+    backing_file = (backing_file or '').encode('utf-8')
+    offset = QCOW2_HEADER_LENGTH if backing_file else 0
+    header = struct.pack('>4sIQIIQ', b'QFI\xfb', 3, offset,
+                         len(backing_file), 16, size)
+    header = header.ljust(72, b'\0') + struct.pack('>QQQII', 0, 0, 0, 4,
+                                                   QCOW2_HEADER_LENGTH)
+    return header.ljust(QCOW2_HEADER_LENGTH, b'\0') + backing_file
+
+
+def write_image(path, size, zero_fraction=0.5, block_size=1024 * 1024):
+    """ Write a size byte image starting with a qcow2 header, alternating
+        random and all-zero blocks.
+    """
+    zero_every = int(1 / zero_fraction) if zero_fraction else 0
+    with open(path, 'wb') as f:
+        f.write(qcow2_header(size).ljust(block_size, b'\0'))
+        written = block_size
+        index = 1
+        while written < size:
+            length = min(block_size, size - written)
+            if zero_every and index % zero_every == 0:
+                f.write(b'\0' * length)
+            else:
+                f.write(os.urandom(length))
+            written += length
+            index += 1
+
+
+def make_payloads(dir, size):
+    """ Create img (uncompressed), img.gz, img.bz2 and img.zip of size
+        bytes in dir. Return the names.
+    """
+    plain = os.path.join(dir, 'img')
+    write_image(plain, size)
+    with open(plain, 'rb') as src:
+        data = src.read()
+    with open(plain + '.gz', 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as gz:
+            gz.write(data)
+    with open(plain + '.bz2', 'wb') as f:
+        f.write(bz2.compress(data, 1))
+    with zipfile.ZipFile(plain + '.zip', 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as z:
+        z.write(plain, 'img.iso')
+    return ['img', 'img.gz', 'img.bz2', 'img.zip']
+
+
+def make_datastore(dir, qcow2_files, raw_files, snapshot_ratio=0.5,
+                   virtual_size=10 * 1024 ** 3):
+    """ Fill dir with qcow2 images (snapshot_ratio of them snapshots of
+        the first bases) and sparse raw images. Return the names.
+    """
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    names = []
+    bases = max(1, int(qcow2_files * (1 - snapshot_ratio)))
+    for i in range(qcow2_files):
+        name = 'disk-%05d.qcow2' % i
+        backing = 'disk-%05d.qcow2' % (i % bases) if i >= bases else None
+        with open(os.path.join(dir, name), 'wb') as f:
+            f.write(qcow2_header(virtual_size, backing))
+        names.append(name)
+    for i in range(raw_files):
+        name = 'disk-%05d.raw' % i
+        with open(os.path.join(dir, name), 'wb') as f:
+            f.truncate(virtual_size)
+        names.append(name)
+    return names
+
+
+def make_trash(dir, files, size=1024 * 1024):
+    """Fill the trash of the datastore dir with files of size bytes."""
+    trash = os.path.join(dir, 'trash')
+    if not os.path.isdir(trash):
+        os.makedirs(trash)
+    block = os.urandom(size)
+    for i in range(files):
+        with open(os.path.join(trash, 'trashed-%05d' % i), 'wb') as f:
+            f.write(block)
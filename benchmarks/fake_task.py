@@ -0,0 +1,57 @@
+""" Stand-in for Celery's AbortableTask counting broker round trips. """
+import uuid
+import threading
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+
+
+class FakeResult(object):
+
+    def __init__(self, task):
+        self.task = task
+
+    @property
+    def state(self):
+        self.task.count('state')
+        return 'PROGRESS'
+
+
+class FakeTask(object):
+
+    """ Records update_state, AsyncResult().state and is_aborted calls.
+        The task reports aborted after abort_after is_aborted calls.
+    """
+
+    def __init__(self, abort_after=None, latency=0):
+        self.request = FakeRequest()
+        self.abort_after = abort_after
+        self.latency = latency
+        self.counts = {'update_state': 0, 'state': 0, 'is_aborted': 0}
+        self.updates = []
+        self.lock = threading.Lock()
+
+    def count(self, call):
+        with self.lock:
+            self.counts[call] += 1
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+    def is_aborted(self):
+        self.count('is_aborted')
+        return (self.abort_after is not None and
+                self.counts['is_aborted'] > self.abort_after)
+
+    def AsyncResult(self, task_id):
+        return FakeResult(self)
+
+    def update_state(self, task_id=None, state=None, meta=None):
+        self.count('update_state')
+        self.updates.append(meta)
+
+    @property
+    def broker_calls(self):
+        return sum(self.counts.values())
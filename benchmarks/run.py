@@ -0,0 +1,303 @@
+""" Run the storage driver benchmarks and compare them to a baseline.
+
+    Every scenario reports throughput, latency percentiles, forks per
+    operation and broker calls per operation. Results are written as
+    JSON with --save-baseline, and --compare exits with status 1 when a
+    scenario regressed beyond --threshold.
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+from time import time
+
+from benchmarks.datastore import (make_datastore, make_payloads, make_trash,
+                                  write_image)
+from benchmarks.fake_task import FakeTask
+from benchmarks.server import PayloadServer
+
+logger = logging.getLogger(__name__)
+
+
+class ForkCounter(object):
+
+    """ Count processes started through subprocess while active. """
+
+    def __init__(self):
+        self.forks = 0
+        self.original = None
+
+    def __enter__(self):
+        counter = self
+        self.original = original = subprocess.Popen
+
+        class CountingPopen(original):
+            def __init__(self, *args, **kwargs):
+                counter.forks += 1
+                super(CountingPopen, self).__init__(*args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+        return self
+
+    def __exit__(self, *exc_info):
+        subprocess.Popen = self.original
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return 0
+    k = (len(samples) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(samples) - 1)
+    return samples[lower] + (samples[upper] - samples[lower]) * (k - lower)
+
+
+def summarize(latencies, total_bytes, forks, broker_calls, updates):
+    operations = len(latencies)
+    elapsed = sum(latencies)
+    return {
+        'operations': operations,
+        'throughput_mb_s': (total_bytes / 1048576.0 / elapsed
+                            if elapsed and total_bytes else 0),
+        'p50_s': percentile(latencies, 50),
+        'p90_s': percentile(latencies, 90),
+        'p99_s': percentile(latencies, 99),
+        'forks_per_op': float(forks) / operations,
+        'broker_calls_per_op': float(broker_calls) / operations,
+        'progress_updates_per_op': float(updates) / operations,
+    }
+
+
+def measure(operation, repeat, setup=None):
+    """ Run operation() repeat times, each after setup(). operation
+        returns (bytes moved, FakeTask or None).
+    """
+    latencies = []
+    total_bytes = forks = broker_calls = updates = 0
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        with ForkCounter() as counter:
+            start = time()
+            moved, task = operation()
+            latencies.append(time() - start)
+        total_bytes += moved
+        forks += counter.forks
+        if task is not None:
+            broker_calls += task.broker_calls
+            updates += task.counts['update_state']
+    return summarize(latencies, total_bytes, forks, broker_calls, updates)
+
+
+def remove(path):
+    if os.path.lexists(path):
+        os.unlink(path)
+
+
+def bench_download(workdir, args):
+    from disk import Disk
+    payloads = os.path.join(workdir, 'payloads')
+    datastore = os.path.join(workdir, 'download')
+    os.makedirs(payloads)
+    os.makedirs(datastore)
+    size = args.size * 1024 * 1024
+    results = {}
+    with PayloadServer(payloads) as server:
+        for name in make_payloads(payloads, size):
+            for ranges in (True, False):
+                disk = Disk(datastore, 'downloaded', 'qcow2', 'normal',
+                            0, None)
+
+                def operation():
+                    task = FakeTask()
+                    disk.download(task, server.url(name, ranges))
+                    return size, task
+
+                key = 'download-%s-%s' % (name,
+                                          'range' if ranges else 'norange')
+                results[key] = measure(
+                    operation, args.repeat,
+                    setup=lambda: remove(disk.get_path()))
+    return results
+
+
+def bench_merge(workdir, args):
+    from capabilities import registry
+    from disk import Disk
+    datastore = os.path.join(workdir, 'merge')
+    os.makedirs(datastore)
+    registry.filesystem(datastore)
+    size = args.size * 1024 * 1024
+    write_image(os.path.join(datastore, 'source.raw'), size)
+    source = Disk(datastore, 'source.raw', 'raw', 'normal', size, None)
+    target = Disk(datastore, 'target.raw', 'raw', 'normal', size, None)
+    results = {}
+
+    def copy():
+        task = FakeTask()
+        source.merge(task, target)
+        return size, task
+
+    results['merge-copy'] = measure(
+        copy, args.repeat, setup=lambda: remove(target.get_path()))
+    try:
+        subprocess.check_output(['qemu-img', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        logger.warning("qemu-img is not available, skipping merge-convert.")
+        return results
+    subprocess.check_output(['qemu-img', 'convert', '-O', 'qcow2',
+                             source.get_path(),
+                             os.path.join(datastore, 'base.qcow2')])
+    subprocess.check_output(['qemu-img', 'create', '-f', 'qcow2', '-b',
+                             'base.qcow2', '-F', 'qcow2',
+                             os.path.join(datastore, 'snap.qcow2')])
+    snapshot = Disk(datastore, 'snap.qcow2', 'qcow2', 'snapshot', size,
+                    'base.qcow2')
+    merged = Disk(datastore, 'merged.qcow2', 'qcow2', 'normal', size, None)
+
+    def convert():
+        task = FakeTask()
+        snapshot.merge(task, merged)
+        return size, task
+
+    results['merge-convert'] = measure(
+        convert, args.repeat, setup=lambda: remove(merged.get_path()))
+    return results
+
+
+def bench_list(workdir, args):
+    import disk
+    datastore = os.path.join(workdir, 'list')
+    make_datastore(datastore, args.files // 2, args.files - args.files // 2)
+
+    def cold():
+        disk.DiskMetadataCache._instances.clear()
+        remove(os.path.join(datastore, disk.state_directory,
+                            'metadata.json'))
+
+    def operation():
+        disk.Disk.list(datastore)
+        return 0, None
+
+    return {
+        'list-cold': measure(operation, args.repeat, setup=cold),
+        'list-warm': measure(operation, args.repeat),
+    }
+
+
+def bench_make_free_space(workdir, args):
+    from reclaim import reclaim
+    datastore = os.path.join(workdir, 'reclaim')
+    os.makedirs(datastore)
+
+    def operation():
+        freed, missing = reclaim(datastore, low=100, high=100)
+        return freed, None
+
+    return {'make-free-space': measure(
+        operation, args.repeat,
+        setup=lambda: make_trash(datastore, args.trash_files))}
+
+
+SCENARIOS = [
+    ('download', bench_download),
+    ('merge', bench_merge),
+    ('list', bench_list),
+    ('make-free-space', bench_make_free_space),
+]
+# lower is better for these, higher for throughput
+COST_METRICS = ('p50_s', 'p90_s', 'forks_per_op', 'broker_calls_per_op',
+                'progress_updates_per_op')
+
+
+def compare(results, baseline, threshold):
+    """Print the change against baseline, return the regressions."""
+    regressions = []
+    for scenario in sorted(results):
+        old = baseline.get('results', {}).get(scenario)
+        if old is None:
+            continue
+        for metric in COST_METRICS + ('throughput_mb_s', ):
+            before, after = old.get(metric, 0), results[scenario][metric]
+            if not before:
+                worse = metric in COST_METRICS and after > before
+                change = 0
+            else:
+                change = (after - before) * 100.0 / before
+                if metric in COST_METRICS:
+                    worse = change > threshold
+                else:
+                    worse = change < -threshold
+            if worse:
+                regressions.append((scenario, metric, before, after))
+            print("%-32s %-24s %12.4f %12.4f %+8.1f%%%s" % (
+                scenario, metric, before, after, change,
+                '  REGRESSION' if worse else ''))
+    return regressions
+
+
+def print_results(results):
+    print("%-32s %10s %9s %9s %9s %7s %8s %8s" % (
+        'scenario', 'MB/s', 'p50 s', 'p90 s', 'p99 s', 'forks',
+        'broker', 'updates'))
+    for scenario in sorted(results):
+        r = results[scenario]
+        print("%-32s %10.1f %9.4f %9.4f %9.4f %7.1f %8.1f %8.1f" % (
+            scenario, r['throughput_mb_s'], r['p50_s'], r['p90_s'],
+            r['p99_s'], r['forks_per_op'], r['broker_calls_per_op'],
+            r['progress_updates_per_op']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=64,
+                        help="image size in MiB for downloads and merges")
+    parser.add_argument('--files', type=int, default=2000,
+                        help="number of images in the listed datastore")
+    parser.add_argument('--trash-files', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append',
+                        help="run only the named scenario groups")
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help="allowed regression in percent")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    # the worker probes its capabilities at startup, not in the scenarios
+    from capabilities import registry
+    registry.qemu_img()
+
+    workdir = tempfile.mkdtemp(prefix='storagedriver-bench-')
+    results = {}
+    try:
+        for name, scenario in SCENARIOS:
+            if args.only and name not in args.only:
+                continue
+            results.update(scenario(workdir, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'size_mib': args.size,
+                       'files': args.files,
+                       'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+""" Local HTTP server serving benchmark payloads.
+
+    Files of the served directory are available under /range/<name>
+    with byte range support and under /plain/<name> without it.
+"""
+import os
+import re
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+re_range = re.compile(r'bytes=(\d+)-(\d*)$')
+block_size = 1024 * 1024
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PayloadHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    root = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        parts = self.path.lstrip('/').split('/', 1)
+        if len(parts) != 2 or parts[0] not in ('range', 'plain'):
+            self.send_error(404)
+            return
+        path = os.path.join(self.root, os.path.basename(parts[1]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        m = re_range.match(self.headers.get('Range', ''))
+        if parts[0] == 'range' and m:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        if parts[0] == 'range':
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', '"%d-%d"' % (
+                size, int(os.path.getmtime(path))))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                data = f.read(min(block_size, left))
+                if not data:
+                    break
+                self.wfile.write(data)
+                left -= len(data)
+
+
+class PayloadServer(object):
+
+    """ Serve root on a free local port in a background thread. """
+
+    def __init__(self, root):
+        handler = type('Handler', (PayloadHandler, ), {'root': root})
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def url(self, name, ranges=True):
+        return 'http://127.0.0.1:%d/%s/%s' % (
+            self.httpd.server_address[1], 'range' if ranges else 'plain',
+            name)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
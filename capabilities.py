@@ -0,0 +1,171 @@
+""" Capabilities of the host, probed once.
+
+    The qemu-img version and the options of its subcommands are read
+    from `qemu-img --version` and `qemu-img --help`, and the features of
+    each datastore's filesystem (reflink, copy_file_range, native
+    fallocate, SEEK_HOLE) are tried on scratch files in its state
+    directory. The worker probes the configured datastores in its main
+    process before the pool processes are forked, so they inherit the
+    results; anything else is probed on first use.
+"""
+import os
+import re
+import errno
+import ctypes
+import logging
+import threading
+import subprocess
+
+import inotify
+from config import state_directory
+from copyengine import SEEK_DATA, UNSUPPORTED, reflink
+
+logger = logging.getLogger(__name__)
+
+re_version = re.compile(r'version (\d+)\.(\d+)(?:\.(\d+))?')
+re_command = re.compile(r'^  (\w+) (.*)$')
+re_option = re.compile(r'\[(--?[\w-]+)')
+
+
+def run(cmdline):
+    """Return the output of cmdline whatever its exit code, None if it
+    can not be run."""
+    try:
+        proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    except OSError:
+        return None
+    return proc.communicate()[0].decode('utf-8', 'replace')
+
+
+def parse_help(output):
+    """Return the options in brackets of each command in the
+    "Command syntax" section of qemu-img's help."""
+    commands = {}
+    for line in output.splitlines():
+        m = re_command.match(line)
+        if m:
+            commands[m.group(1)] = sorted(set(re_option.findall(m.group(2))))
+    return commands
+
+
+def probe_qemu_img():
+    version = run(['qemu-img', '--version'])
+    if version is None:
+        logger.warning("qemu-img is not available.")
+        return {'available': False, 'version': None, 'commands': {},
+                'json': True, 'progress': True, 'out_of_order': False,
+                'force_share': False, 'rate_limit': False}
+    m = re_version.search(version)
+    commands = parse_help(run(['qemu-img', '--help']) or '')
+    info = commands.get('info', [])
+    convert = commands.get('convert', [])
+    return {
+        'available': True,
+        'version': [int(v or 0) for v in m.groups()] if m else None,
+        'commands': commands,
+        # without a readable help, assume a current qemu-img
+        'json': '--output' in info or 'info' not in commands,
+        'progress': '-p' in convert or 'convert' not in commands,
+        'out_of_order': '-W' in convert,
+        'force_share': '-U' in info,
+        'rate_limit': '-r' in convert,
+    }
+
+
+def native_fallocate(fd, length):
+    """Allocate with the fallocate syscall, which, unlike
+    posix_fallocate, does not fall back to writing zeros."""
+    libc = inotify.libc()
+    fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                          ctypes.c_int64]
+    if fallocate(fd, 0, 0, length) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+def probe_filesystem(datastore):
+    features = {'reflink': False, 'copy_file_range': False,
+                'fallocate': False, 'seek_hole': False}
+    directory = os.path.join(datastore, state_directory)
+    paths = [os.path.join(directory, 'capabilities.%d.%s' % (os.getpid(), n))
+             for n in 'abc']
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(paths[0], 'w+b') as a, open(paths[1], 'wb') as b, \
+                open(paths[2], 'wb') as c:
+            a.seek(1024 * 1024)
+            a.write(b'\1' * 65536)
+            a.flush()
+            try:
+                features['seek_hole'] = os.lseek(a.fileno(), 0,
+                                                 SEEK_DATA) > 0
+            except OSError as e:
+                if e.errno not in UNSUPPORTED + (errno.ENXIO, ):
+                    raise
+            features['reflink'] = reflink(a.fileno(), b.fileno())
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    os.copy_file_range(a.fileno(), c.fileno(), 65536,
+                                       1024 * 1024, 0)
+                    features['copy_file_range'] = True
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED:
+                        raise
+            try:
+                native_fallocate(c.fileno(), 1024 * 1024)
+                features['fallocate'] = True
+            except (OSError, AttributeError):
+                pass
+    except (IOError, OSError):
+        logger.warning("Cannot probe the filesystem of %s.", datastore,
+                       exc_info=True)
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.unlink(path)
+    return features
+
+
+class Capabilities(object):
+
+    """ The probed capabilities of the host and its datastores. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.qemu = None
+        self.filesystems = {}
+
+    def qemu_img(self):
+        with self.lock:
+            if self.qemu is None:
+                self.qemu = probe_qemu_img()
+            return self.qemu
+
+    def filesystem(self, datastore):
+        datastore = os.path.realpath(datastore)
+        with self.lock:
+            features = self.filesystems.get(datastore)
+            if features is None:
+                features = self.filesystems[datastore] = probe_filesystem(
+                    datastore)
+            return features
+
+    def probe(self, datastores):
+        """Probe qemu-img and the filesystems of datastores."""
+        qemu = self.qemu_img()
+        logger.info("qemu-img %s: %s.", '.'.join(
+            str(v) for v in qemu['version'] or ['?']), ', '.join(
+            name for name in ('json', 'progress', 'out_of_order',
+                              'force_share', 'rate_limit') if qemu[name]))
+        for datastore in datastores:
+            features = self.filesystem(datastore)
+            logger.info("Filesystem of %s: %s.", datastore, ', '.join(
+                name for name in sorted(features) if features[name]))
+
+
+registry = Capabilities()
+qemu_img = registry.qemu_img
+filesystem = registry.filesystem
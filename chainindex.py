@@ -0,0 +1,159 @@
+""" Backing-chain index of a datastore.
+
+    Records the base image of every disk, so children, ancestors, chain
+    depth and whether a disk is safe to trash are answered without
+    probing the datastore. The index is persisted in the datastore's
+    state directory and every change is made under a file lock after
+    reloading it, so the worker processes of a host share one graph.
+"""
+import os
+import json
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+
+from config import state_directory
+
+logger = logging.getLogger(__name__)
+
+
+class ChainIndex(object):
+
+    """ Parent and children maps of the disks of one datastore. """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dir):
+        self.dir = os.path.realpath(dir)
+        self.path = os.path.join(self.dir, state_directory, 'chains.json')
+        self.lock_path = self.path + '.lock'
+        self.parents = {}
+        self.children = {}
+        self.loaded_mtime = None
+        self.lock = threading.RLock()
+
+    @classmethod
+    def for_dir(cls, dir, build=True):
+        """Return the shared index of the datastore. Unless build is
+        false, it is built with a scan the first time."""
+        dir = os.path.realpath(dir)
+        with cls._instances_lock:
+            index = cls._instances.get(dir)
+            if index is None:
+                index = cls._instances[dir] = cls(dir)
+        if not index.refresh() and build:
+            index.build()
+        return index
+
+    def set_parents(self, parents):
+        self.parents = parents
+        self.children = {}
+        for name, base_name in parents.items():
+            if base_name:
+                self.children.setdefault(base_name, set()).add(name)
+
+    def refresh(self):
+        """Reload the index if it changed on disk, return False if there
+        is no saved index."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        with self.lock:
+            if mtime != self.loaded_mtime:
+                try:
+                    with open(self.path) as f:
+                        self.set_parents(json.load(f))
+                except (IOError, OSError, ValueError):
+                    logger.warning("Ignoring unreadable chain index %s",
+                                   self.path)
+                    return False
+                self.loaded_mtime = mtime
+        return True
+
+    def save(self):
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.parents, f)
+        os.rename(tmp_path, self.path)
+        self.loaded_mtime = os.stat(self.path).st_mtime
+
+    def acquire(self):
+        state_dir = os.path.dirname(self.path)
+        if not os.path.isdir(state_dir):
+            os.mkdir(state_dir)
+        lock = open(self.lock_path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    @contextmanager
+    def transaction(self, create=False):
+        """Change the index under the inter-process lock. The change is
+        kept in memory only if the datastore is read-only, or if there is
+        no saved index and create is false."""
+        with self.lock:
+            try:
+                lock = self.acquire()
+            except (IOError, OSError):
+                logger.warning("Cannot lock chain index %s", self.path,
+                               exc_info=True)
+                lock = None
+            try:
+                saved = lock is not None and self.refresh()
+                yield self
+                if lock is not None and (saved or create):
+                    self.save()
+            finally:
+                if lock is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    lock.close()
+
+    def build(self):
+        """Rebuild the index from a scan of the datastore."""
+        from inventory import scan
+        self.rebuild(scan(self.dir)['disks'])
+
+    def rebuild(self, disks):
+        """Replace the index with the chains of the given Disk objects."""
+        with self.transaction(create=True):
+            self.set_parents(dict((d.name, d.base_name) for d in disks))
+
+    def add(self, name, base_name=None):
+        with self.transaction():
+            self.remove_edge(name)
+            self.parents[name] = base_name
+            if base_name:
+                self.children.setdefault(base_name, set()).add(name)
+
+    def remove(self, name):
+        with self.transaction():
+            self.remove_edge(name)
+            self.parents.pop(name, None)
+
+    def remove_edge(self, name):
+        base_name = self.parents.get(name)
+        if base_name and base_name in self.children:
+            self.children[base_name].discard(name)
+            if not self.children[base_name]:
+                del self.children[base_name]
+
+    def get_children(self, name):
+        return sorted(self.children.get(name, ()))
+
+    def ancestors(self, name):
+        """Return the bases of name, nearest first."""
+        chain = []
+        base_name = self.parents.get(name)
+        while base_name and base_name not in chain:
+            chain.append(base_name)
+            base_name = self.parents.get(base_name)
+        return chain
+
+    def depth(self, name):
+        return len(self.ancestors(name))
+
+    def is_safe_to_trash(self, name):
+        """Whether no disk of the datastore is based on name."""
+        return not self.children.get(name)
@@ -0,0 +1,141 @@
+""" Image checksums.
+
+    Digests are computed while the data streams through the driver and
+    kept in a sidecar file under the datastore's state directory, so the
+    image is not read back until it changes. Sidecars are removed with
+    their image, and orphans are pruned when trash is reclaimed.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from time import time
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+ALGORITHMS = [a for a in ('md5', 'sha256', 'blake2b')
+              if hasattr(hashlib, a)]
+default_algorithm = os.getenv("CHECKSUM_ALGORITHM", "md5")
+checksum_directory = "checksums"
+
+
+def new_hash(algorithm=None):
+    algorithm = algorithm or default_algorithm
+    if algorithm not in ALGORITHMS:
+        raise Exception('Invalid checksum algorithm: %s' % algorithm)
+    return getattr(hashlib, algorithm)()
+
+
+class HashStage(object):
+
+    """ Hash a stream of chunks on a separate thread.
+        Hashing releases the GIL, so it overlaps the writes of the
+        caller. The queue is bounded to keep memory use flat.
+    """
+
+    def __init__(self, algorithm=None, queue_size=64):
+        self.algorithm = algorithm or default_algorithm
+        self.hash = new_hash(self.algorithm)
+        self.seconds = 0
+        self.queue = Queue(queue_size)
+        self.thread = threading.Thread(target=self._run,
+                                       name='hash-%s' % self.algorithm)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            start = time()
+            self.hash.update(chunk)
+            self.seconds += time() - start
+
+    def update(self, chunk):
+        if chunk:
+            self.queue.put(chunk)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def reset(self):
+        """Drop everything hashed so far."""
+        self.close()
+        seconds = self.seconds
+        self.__init__(self.algorithm, self.queue.maxsize)
+        self.seconds = seconds
+
+    def hexdigest(self):
+        self.close()
+        return self.hash.hexdigest()
+
+
+def sidecar_path(state_dir, name, algorithm):
+    return os.path.join(state_dir, checksum_directory,
+                        '%s.%s' % (name, algorithm))
+
+
+def stat_key(path):
+    st = os.stat(path)
+    return [st.st_ino, st.st_mtime, st.st_size]
+
+
+def read_sidecar(path, state_dir, name, algorithm):
+    """Return the saved digest of path if it is still up to date."""
+    try:
+        with open(sidecar_path(state_dir, name, algorithm)) as f:
+            saved = json.load(f)
+        if saved['key'] == stat_key(path):
+            return saved['digest']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def write_sidecar(path, state_dir, name, algorithm, digest):
+    sidecar = sidecar_path(state_dir, name, algorithm)
+    try:
+        if not os.path.isdir(os.path.dirname(sidecar)):
+            os.makedirs(os.path.dirname(sidecar))
+        with open(sidecar + '~', 'w') as f:
+            json.dump({'key': stat_key(path), 'digest': digest}, f)
+        os.rename(sidecar + '~', sidecar)
+    except (IOError, OSError):
+        logger.warning("Cannot save checksum of %s", path, exc_info=True)
+
+
+def remove_sidecars(state_dir, name):
+    """Remove the saved digests of the image name."""
+    for algorithm in ALGORITHMS:
+        sidecar = sidecar_path(state_dir, name, algorithm)
+        if os.path.exists(sidecar):
+            os.unlink(sidecar)
+
+
+def prune_sidecars(state_dir, names):
+    """Remove the saved digests of images not listed in names."""
+    directory = os.path.join(state_dir, checksum_directory)
+    if not os.path.isdir(directory):
+        return
+    names = set(names)
+    for sidecar in os.listdir(directory):
+        name, _, algorithm = sidecar.rpartition('.')
+        if algorithm in ALGORITHMS and name not in names:
+            os.unlink(os.path.join(directory, sidecar))
+
+
+def file_checksum(path, algorithm=None, blocksize=1024 * 1024):
+    """Hash the file at path."""
+    hash = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            hash.update(block)
+    return hash.hexdigest()
@@ -0,0 +1,52 @@
+""" Per-datastore settings.
+
+    Settings are JSON objects in environment variables. The "default"
+    key applies to every datastore, and a key with the path of a
+    datastore overrides its members for that datastore, e.g.
+
+        MERGE_OPTIONS='{"default": {"coroutines": 8},
+                        "/datastore": {"out_of_order": true}}'
+"""
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Hidden per-datastore directory for the driver's own bookkeeping files.
+state_directory = ".storagedriver"
+
+_parsed = {}
+
+
+def getenv_bool(name, default):
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+def datastores():
+    """Return the datastore paths configured in DATASTORES, separated by
+    colons."""
+    return [os.path.realpath(d)
+            for d in os.getenv('DATASTORES', '').split(':') if d]
+
+
+def load(variable):
+    if variable not in _parsed:
+        try:
+            _parsed[variable] = json.loads(os.getenv(variable) or '{}')
+        except ValueError:
+            logger.error("Ignoring invalid JSON in %s.", variable)
+            _parsed[variable] = {}
+    return _parsed[variable]
+
+
+def datastore_options(variable, datastore, defaults=None):
+    """Return the settings in variable which apply to datastore."""
+    settings = load(variable)
+    options = dict(defaults or {})
+    options.update(settings.get('default', {}))
+    datastore = os.path.realpath(datastore)
+    for key, value in settings.items():
+        if key != 'default' and os.path.realpath(key) == datastore:
+            options.update(value)
+    return options
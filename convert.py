@@ -0,0 +1,121 @@
+""" qemu-img convert engine for merges.
+
+    Progress is read from `qemu-img convert -p`, and the tuning options
+    of qemu-img are per-datastore settings in MERGE_OPTIONS:
+
+        out_of_order   allow out-of-order writes (-W)
+        coroutines     number of parallel coroutines (-m)
+        cache          cache mode of the target (-t)
+        source_cache   cache mode of the source (-T)
+        compress       compress qcow2 targets (-c)
+        sparse_size    minimum zero run detected as a hole (-S)
+        rate_limit     bytes per second written (-r)
+        ionice         I/O class of the process, e.g. "idle"
+
+    The merge limits of IO_LIMITS are added by iolimits.convert_limits.
+"""
+import os
+import re
+import select
+import logging
+import subprocess
+
+from capabilities import qemu_img
+from config import datastore_options
+from iolimits import ionice_cmdline
+from metrics import subprocess_timer
+
+logger = logging.getLogger(__name__)
+
+re_progress = re.compile(br'\((\d+(?:\.\d+)?)/100%\)')
+poll_interval = 0.5
+
+
+def merge_options(datastore):
+    return datastore_options('MERGE_OPTIONS', datastore)
+
+
+def convert_cmdline(source, target, format, options):
+    """Return the qemu-img convert command, leaving out the options the
+    installed qemu-img does not list."""
+    supported = qemu_img()['commands'].get('convert')
+
+    def add(option, *values):
+        if supported is None or option in supported:
+            cmdline.append(option)
+            cmdline.extend(values)
+        else:
+            logger.debug("qemu-img convert has no %s option.", option)
+
+    cmdline = ['qemu-img', 'convert']
+    add('-p')
+    if options.get('out_of_order'):
+        add('-W')
+    if options.get('coroutines'):
+        add('-m', str(options['coroutines']))
+    if options.get('cache'):
+        add('-t', options['cache'])
+    if options.get('source_cache'):
+        add('-T', options['source_cache'])
+    if options.get('compress') and format == 'qcow2':
+        add('-c')
+    if options.get('sparse_size') is not None:
+        add('-S', str(options['sparse_size']))
+    if options.get('rate_limit'):
+        add('-r', str(options['rate_limit']))
+    cmdline.extend([source, '-O', format, target])
+    return cmdline
+
+
+class AbortConvert(Exception):
+    pass
+
+
+def convert(source, target, format, options=None, on_progress=None,
+            aborted=None):
+    """ Run qemu-img convert from source to target.
+        on_progress(percent) is called with the progress qemu-img
+        reports; if aborted() returns true the process is terminated and
+        AbortConvert is raised. Return as soon as the process exits.
+    """
+    options = options or {}
+    cmdline = convert_cmdline(source, target, format, options)
+    logger.debug("Converting: %s", cmdline)
+    with subprocess_timer(cmdline):
+        proc = subprocess.Popen(ionice_cmdline(options.get('ionice')) +
+                                cmdline, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        streams = {proc.stdout.fileno(): b'', proc.stderr.fileno(): b''}
+        try:
+            while streams:
+                if aborted is not None and aborted():
+                    raise AbortConvert()
+                readable = select.select(list(streams), [], [],
+                                         poll_interval)[0]
+                for fd in readable:
+                    data = os.read(fd, 4096)
+                    if not data:
+                        if fd == proc.stderr.fileno():
+                            stderr = streams[fd]
+                        del streams[fd]
+                        continue
+                    if fd == proc.stdout.fileno():
+                        matches = re_progress.findall(streams[fd] + data)
+                        # keep the tail in case a report is split
+                        streams[fd] = (streams[fd] + data)[-32:]
+                        if matches and on_progress is not None:
+                            on_progress(float(matches[-1]))
+                    else:
+                        streams[fd] += data
+            returncode = proc.wait()
+        except:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmdline,
+                                            stderr.decode('utf-8', 'replace'))
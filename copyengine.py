@@ -0,0 +1,139 @@
+""" Sparse-aware, zero-copy file copy.
+
+    A copy is first tried as a reflink (FICLONE), which shares the
+    extents on XFS and btrfs. Otherwise only the data extents of the
+    source are copied, found with SEEK_DATA/SEEK_HOLE, using
+    copy_file_range or sendfile so the data does not pass through
+    userspace. Holes stay holes in the copy.
+"""
+import os
+import errno
+import fcntl
+import logging
+
+logger = logging.getLogger(__name__)
+
+FICLONE = 0x40049409
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+chunk_size = 64 * 1024 * 1024
+# smaller chunks keep a throttled copy smooth
+throttle_chunk_size = 4 * 1024 * 1024
+# errors meaning the method is not available for these files
+UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+               errno.ENOTTY, errno.EBADF)
+
+
+class AbortCopy(Exception):
+    pass
+
+
+def reflink(src_fd, dst_fd):
+    """Clone src into dst, return False if the filesystem can't."""
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+
+
+def data_extents(fd, size):
+    """Yield (offset, length) of the data extents of fd."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # only a hole is left
+                return
+            if e.errno in UNSUPPORTED:
+                yield offset, size - offset
+                return
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield start, min(end, size) - start
+        offset = end
+
+
+def copy_with_read(src_fd, dst_fd, offset, length):
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    buf = os.read(src_fd, min(length, 1024 * 1024))
+    if not buf:
+        return 0
+    return os.write(dst_fd, buf)
+
+
+def copy_with_sendfile(src_fd, dst_fd, offset, length):
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, length)
+
+
+def copy_with_copy_file_range(src_fd, dst_fd, offset, length):
+    return os.copy_file_range(src_fd, dst_fd, length, offset, offset)
+
+
+class CopyEngine(object):
+
+    """ Copy files with the fastest method which works for them. """
+
+    def __init__(self, use_reflink=True, use_copy_file_range=True):
+        self.use_reflink = use_reflink
+        self.methods = [copy_with_read]
+        if hasattr(os, 'sendfile'):
+            self.methods.insert(0, copy_with_sendfile)
+        if use_copy_file_range and hasattr(os, 'copy_file_range'):
+            self.methods.insert(0, copy_with_copy_file_range)
+
+    def copy_range(self, src_fd, dst_fd, offset, length):
+        """Copy up to length bytes at offset, return the bytes copied."""
+        while True:
+            method = self.methods[0]
+            try:
+                return method(src_fd, dst_fd, offset, length)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED or len(self.methods) == 1:
+                    raise
+                logger.debug("%s is not usable, falling back.",
+                             method.__name__)
+                self.methods.pop(0)
+
+    def copy(self, src, dst, on_progress=None, aborted=None, throttle=None):
+        """ Copy src to dst keeping holes.
+            on_progress(position) reports the offset the copy reached;
+            if aborted() returns true AbortCopy is raised. throttle(size)
+            is called before each chunk is copied, and may sleep; while
+            it returns true the chunks are smaller.
+            Return the method used.
+        """
+        size_limit = chunk_size if throttle is None else throttle_chunk_size
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            src_fd = fsrc.fileno()
+            dst_fd = fdst.fileno()
+            size = os.fstat(src_fd).st_size
+            if self.use_reflink and reflink(src_fd, dst_fd):
+                if on_progress is not None:
+                    on_progress(size)
+                return 'reflink'
+            os.ftruncate(dst_fd, size)
+            for start, length in data_extents(src_fd, size):
+                offset = start
+                end = start + length
+                while offset < end:
+                    if aborted is not None and aborted():
+                        raise AbortCopy()
+                    length = min(size_limit, end - offset)
+                    if throttle is not None:
+                        size_limit = (throttle_chunk_size if throttle(length)
+                                      else chunk_size)
+                    copied = self.copy_range(src_fd, dst_fd, offset, length)
+                    if copied == 0:
+                        break  # source shrank
+                    offset += copied
+                    if on_progress is not None:
+                        on_progress(offset)
+            if on_progress is not None:
+                on_progress(size)
+            return self.methods[0].__name__
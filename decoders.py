@@ -0,0 +1,399 @@
+""" Streaming decoders for compressed image downloads.
+
+    Every decoder turns the downloaded chunks into blocks of the final
+    image, so compressed and zipped images are written only once.
+    The decoder is chosen by the magic bytes of the stream, or by the
+    Content-Type and the extension of the url when the head is too
+    short to tell.
+"""
+import struct
+import zlib
+import bz2
+import logging
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+block_size = 4 * 1024 * 1024
+# Yielded by a decoder when the blocks written so far have to be dropped.
+RESET = object()
+
+
+class DecoderError(Exception):
+    pass
+
+
+def drain(obj, data, limit=block_size):
+    """ Feed data to a decompressor object and yield its output in
+        blocks of at most limit bytes, so highly compressed input does
+        not have to fit in memory at once.
+    """
+    if hasattr(obj, 'unconsumed_tail'):  # zlib
+        while True:
+            out = obj.decompress(data, limit)
+            if out:
+                yield out
+            data = obj.unconsumed_tail
+            if not data and len(out) < limit:
+                break
+    elif hasattr(obj, 'needs_input'):  # bz2 and lzma on Python 3.5+
+        out = obj.decompress(data, limit)
+        if out:
+            yield out
+        while not obj.eof and not obj.needs_input:
+            out = obj.decompress(b'', limit)
+            if out:
+                yield out
+    else:
+        out = obj.decompress(data)
+        if out:
+            yield out
+
+
+def is_eof(obj):
+    """Whether obj has reached the end of its stream, None if unknown."""
+    eof = getattr(obj, 'eof', None)
+    if eof is None and getattr(obj, 'unused_data', b''):
+        return True
+    return eof
+
+
+class IdentityDecoder(object):
+
+    def decode(self, data):
+        if data:
+            yield data
+
+    def finish(self):
+        return iter(())
+
+
+class FramedDecoder(object):
+
+    """ Decode a stream of one or more concatenated frames, like the
+        members written by pigz or pbzip2.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.obj = factory()
+        self.started = False
+
+    def decode(self, data):
+        while data:
+            self.started = True
+            try:
+                for out in drain(self.obj, data):
+                    yield out
+            except (EOFError, zlib.error, IOError) as e:
+                raise DecoderError(str(e))
+            if not is_eof(self.obj):
+                break
+            data = getattr(self.obj, 'unused_data', b'')
+            self.obj = self.factory()
+            self.started = False
+
+    def finish(self):
+        if hasattr(self.obj, 'flush'):
+            out = self.obj.flush()
+            if out:
+                yield out
+        if self.started and is_eof(self.obj) is False:
+            raise DecoderError("Compressed stream is truncated.")
+
+
+class ZipMemberDecoder(object):
+
+    """ Extract one member of a zip archive while it is downloaded.
+        Like the former post-download extraction, the archive has to hold
+        exactly one member or exactly one .iso member. A first member
+        which is not an .iso is written speculatively and dropped with
+        RESET if an .iso member follows. Stored members written with a
+        data descriptor end where a descriptor matching their CRC and
+        size is followed by the next header.
+    """
+    LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+    LOCAL_SIGNATURE = b'PK\x03\x04'
+    END_SIGNATURES = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+    DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+    def __init__(self):
+        self.buffer = b''
+        self.state = 'header'
+        self.names = []
+        self.selected = None
+        self.speculative = False
+        self.member = None
+
+    def start_member(self, name, flags, method, crc, csize, usize):
+        self.names.append(name)
+        emit = False
+        if self.selected is None:
+            emit = True
+            self.speculative = not name.lower().endswith('.iso')
+        elif self.speculative and name.lower().endswith('.iso'):
+            emit = True
+            self.speculative = False
+        if emit:
+            self.selected = name
+        if method == 0:
+            decompressor = None
+        elif method == 8:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == 12:
+            decompressor = bz2.BZ2Decompressor()
+        else:
+            raise DecoderError("Unsupported zip compression method %d." %
+                               method)
+        self.member = {
+            'name': name, 'emit': emit, 'decompressor': decompressor,
+            'descriptor': bool(flags & 0x08), 'crc': crc,
+            'left': None if flags & 0x08 else csize, 'actual_crc': 0,
+            'size': 0}
+        self.state = 'data'
+
+    def parse_header(self):
+        """Parse a local file header, return False if more data needed."""
+        if len(self.buffer) < 4:
+            return False
+        if self.buffer[:4] in self.END_SIGNATURES:
+            self.state = 'end'
+            return True
+        if self.buffer[:4] != self.LOCAL_SIGNATURE:
+            raise DecoderError("Invalid zip local file header.")
+        if len(self.buffer) < self.LOCAL_HEADER.size:
+            return False
+        (sig, version, flags, method, mtime, mdate, crc, csize, usize,
+         name_len, extra_len) = self.LOCAL_HEADER.unpack_from(self.buffer)
+        end = self.LOCAL_HEADER.size + name_len + extra_len
+        if len(self.buffer) < end:
+            return False
+        name = self.buffer[self.LOCAL_HEADER.size:
+                           self.LOCAL_HEADER.size + name_len]
+        name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = self.buffer[self.LOCAL_HEADER.size + name_len:end]
+        if 0xFFFFFFFF in (csize, usize):
+            usize, csize = self.parse_zip64(extra, usize, csize)
+        self.buffer = self.buffer[end:]
+        self.start_member(name, flags, method, crc, csize, usize)
+        return True
+
+    def parse_zip64(self, extra, usize, csize):
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag, size = struct.unpack_from('<HH', extra, pos)
+            if tag == 0x0001:
+                fields = extra[pos + 4:pos + 4 + size]
+                offset = 0
+                if usize == 0xFFFFFFFF:
+                    usize = struct.unpack_from('<Q', fields, offset)[0]
+                    offset += 8
+                if csize == 0xFFFFFFFF:
+                    csize = struct.unpack_from('<Q', fields, offset)[0]
+                return usize, csize
+            pos += 4 + size
+        raise DecoderError("Missing zip64 extra field.")
+
+    def match_descriptor(self, data, pos):
+        """ Return the width of the data descriptor at pos if it ends
+            the stored member, 0 if it does not, None if more data is
+            needed to tell.
+        """
+        if len(data) < pos + 28:
+            return None
+        member = self.member
+        crc = zlib.crc32(data[:pos], member['actual_crc']) & 0xFFFFFFFF
+        size = member['size'] + pos
+        for width, sizes in ((16, '<II'), (24, '<QQ')):
+            if (struct.unpack_from('<I', data, pos + 4)[0] == crc and
+                    struct.unpack_from(sizes, data, pos + 8) ==
+                    (size, size) and
+                    data[pos + width:pos + width + 4] in
+                    (self.LOCAL_SIGNATURE, ) + self.END_SIGNATURES):
+                return width
+        return 0
+
+    def stored_data(self):
+        """Yield the buffered data of a stored member of unknown size,
+        up to its data descriptor."""
+        member = self.member
+        data = self.buffer
+        # a descriptor signature may be cut at the end of the buffer
+        end, width = max(0, len(data) - 3), None
+        pos = data.find(self.DESCRIPTOR_SIGNATURE)
+        while pos >= 0:
+            width = self.match_descriptor(data, pos)
+            if width != 0:
+                end = pos
+                break
+            pos = data.find(self.DESCRIPTOR_SIGNATURE, pos + 1)
+        block = data[:end]
+        self.buffer = data[end:]
+        member['actual_crc'] = zlib.crc32(block, member['actual_crc'])
+        member['size'] += len(block)
+        if block and member['emit']:
+            yield block
+        if width:
+            self.buffer = self.buffer[width:]
+            self.state = 'header'
+
+    def member_data(self):
+        """Decode the buffered data of the current member."""
+        member = self.member
+        if member['decompressor'] is None and member['left'] is None:
+            for block in self.stored_data():
+                yield block
+            return
+        data = self.buffer
+        if member['left'] is not None:
+            data = data[:member['left']]
+            member['left'] -= len(data)
+        self.buffer = self.buffer[len(data):]
+        decompressor = member['decompressor']
+        if not member['emit'] and member['left'] is not None:
+            member['crc'] = None  # skipped without decoding
+        elif decompressor is None:
+            member['actual_crc'] = zlib.crc32(data, member['actual_crc'])
+            if data:
+                yield data
+        else:
+            try:
+                for block in drain(decompressor, data):
+                    member['actual_crc'] = zlib.crc32(block,
+                                                      member['actual_crc'])
+                    if member['emit']:
+                        yield block
+            except (EOFError, zlib.error, IOError) as e:
+                raise DecoderError(str(e))
+        if member['left'] == 0:
+            self.end_member()
+        elif member['left'] is None and is_eof(decompressor):
+            self.buffer = decompressor.unused_data + self.buffer
+            self.state = 'descriptor'
+
+    def end_member(self):
+        member = self.member
+        if (not member['descriptor'] and member['crc'] is not None and
+                member['actual_crc'] & 0xFFFFFFFF != member['crc']):
+            raise DecoderError("CRC mismatch in zip member %s." %
+                               member['name'])
+        self.state = 'header'
+
+    def skip_descriptor(self):
+        """Skip a data descriptor of unknown width."""
+        if len(self.buffer) < 28:
+            return False
+        for offset in (16, 24, 12, 20):
+            if (self.buffer[offset:offset + 4] in
+                    (self.LOCAL_SIGNATURE, ) + self.END_SIGNATURES):
+                if offset in (16, 24) and (self.buffer[:4] !=
+                                           self.DESCRIPTOR_SIGNATURE):
+                    continue
+                self.buffer = self.buffer[offset:]
+                self.state = 'header'
+                return True
+        raise DecoderError("Invalid zip data descriptor.")
+
+    def decode(self, data):
+        self.buffer += data
+        while self.buffer and self.state != 'end':
+            if self.state == 'header':
+                was_speculative = self.speculative
+                selected = self.selected
+                if not self.parse_header():
+                    return
+                if self.state == 'data' and self.member['emit'] and (
+                        was_speculative and selected is not None):
+                    logger.info("Dropping %s for %s.", selected,
+                                self.selected)
+                    yield RESET
+            elif self.state == 'data':
+                before = len(self.buffer)
+                for block in self.member_data():
+                    yield block
+                if self.state == 'data' and len(self.buffer) == before:
+                    return
+            elif self.state == 'descriptor':
+                if not self.skip_descriptor():
+                    return
+        if self.state == 'end':
+            self.buffer = b''
+
+    def finish(self):
+        if self.state != 'end':
+            raise DecoderError("Zip archive is truncated.")
+        isos = [n for n in self.names if n.lower().endswith('.iso')]
+        if len(self.names) != 1 and len(isos) != 1:
+            raise DecoderError("Zip archive has no single member to "
+                               "extract: %s" % ', '.join(self.names))
+        logger.info("Extracted %s from zip archive.", self.selected)
+        return iter(())
+
+
+def gzip_decoder():
+    # undocumented zlib feature http://stackoverflow.com/a/2424549
+    return FramedDecoder(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+
+def bz2_decoder():
+    return FramedDecoder(bz2.BZ2Decompressor)
+
+
+def xz_decoder():
+    return FramedDecoder(lzma.LZMADecompressor)
+
+
+def zstd_decoder():
+    return FramedDecoder(
+        lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+# name, magic bytes, content types, extensions, factory
+DECODERS = [
+    ('gzip', b'\x1f\x8b', ('application/gzip', 'application/x-gzip'),
+     ('gz', ), gzip_decoder),
+    ('bz2', b'BZh', ('application/x-bzip2', ), ('bz2', ), bz2_decoder),
+    ('zip', ZipMemberDecoder.LOCAL_SIGNATURE,
+     ('application/zip', 'application/x-zip-compressed'),
+     ('zip', ), ZipMemberDecoder),
+]
+if lzma is not None:
+    DECODERS.append(('xz', b'\xfd7zXZ\x00', ('application/x-xz', ),
+                     ('xz', ), xz_decoder))
+if zstandard is not None:
+    DECODERS.append(('zstd', b'\x28\xb5\x2f\xfd', ('application/zstd', ),
+                     ('zst', ), zstd_decoder))
+MAGIC_LENGTH = 6
+
+
+def detect(url, content_type=None, head=b''):
+    """Return the name of the decoder for the stream, None if it is not
+    compressed."""
+    for name, magic, content_types, extensions, factory in DECODERS:
+        if head.startswith(magic):
+            return name
+    if len(head) >= MAGIC_LENGTH:
+        return None
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    ext = url.split('?')[0].split('.')[-1].lower()
+    for name, magic, content_types, extensions, factory in DECODERS:
+        if content_type in content_types or ext in extensions:
+            return name
+    return None
+
+
+def get_decoder(name):
+    """Return a new decoder object by name, None means identity."""
+    if name is None:
+        return IdentityDecoder()
+    for decoder_name, magic, content_types, extensions, factory in DECODERS:
+        if decoder_name == name:
+            return factory()
+    raise DecoderError("Unsupported compression: %s" % name)
@@ -3,15 +3,32 @@ import os
 import subprocess
 import logging
 import magic
-from shutil import move, copyfileobj
-from zipfile import ZipFile, is_zipfile
-from zlib import decompressobj, MAX_WBITS
-from bz2 import BZ2Decompressor
-from time import sleep
-from hashlib import md5
+import threading
+from collections import OrderedDict
+from itertools import chain
 import re
-
-import requests
+from time import time
+
+from capabilities import filesystem, qemu_img
+from chainindex import ChainIndex
+from checksum import (HashStage, default_algorithm, file_checksum,
+                      read_sidecar, remove_sidecars, write_sidecar)
+from copyengine import AbortCopy, CopyEngine
+from config import state_directory
+from convert import AbortConvert, convert, merge_options
+from decoders import RESET, detect, get_decoder
+from downloader import (RangedDownload, journal_directory, piece_size,
+                        supports_ranges, validator)
+from exporter import (AbortExport, Exporter, expire_exports,
+                      export_directory)
+from httppool import AbortRequest, http_pool
+from imageinfo import read_image_info
+from iolimits import convert_limits, rate_limiter
+from metrics import Operation, collect, flush, inc, subprocess_timer
+from overlaypool import OverlayPool
+from progress import ProgressReporter
+from sparsewriter import SparseWriter, preallocate, preallocate_downloads
+from templatecache import TemplateCache, conditional_headers
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +38,8 @@ re_qemu_img = re.compile(r'(file format: (?P<format>(qcow2|raw))|'
 
 maximum_size = float(os.getenv("DOWNLOAD_MAX_SIZE", 1024*1024*1024*10))
 
+metadata_cache_size = int(os.getenv("METADATA_CACHE_SIZE", 100000))
+
 
 class AbortException(Exception):
     pass
@@ -30,6 +49,140 @@ class FileTooBig(Exception):
     pass
 
 
+class DiskMetadataCache(object):
+
+    """ Persistent cache of probed image metadata for one datastore.
+        Entries are keyed by file name and validated against the
+        (device, inode, mtime, size) tuple of the file, so any change
+        to the image makes it probed again. The least recently used
+        entries are evicted above metadata_cache_size. Hits and misses
+        are counted in the metrics of the process, merged per worker by
+        stats.
+    """
+    FIELDS = ('format', 'type', 'size', 'actual_size', 'base_name')
+    METRIC = 'storagedriver_metadata_cache_requests_total'
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dir, max_entries=metadata_cache_size):
+        self.dir = os.path.realpath(dir)
+        self.path = os.path.join(self.dir, state_directory, 'metadata.json')
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.loaded_mtime = None
+        self.lock = threading.RLock()
+
+    @classmethod
+    def for_dir(cls, dir):
+        """Return the shared cache of the datastore, loading it if needed."""
+        dir = os.path.realpath(dir)
+        with cls._instances_lock:
+            cache = cls._instances.get(dir)
+            if cache is None:
+                cache = cls._instances[dir] = cls(dir)
+        cache.refresh()
+        return cache
+
+    @staticmethod
+    def stat_key(st):
+        return [st.st_dev, st.st_ino, st.st_mtime, st.st_size]
+
+    def refresh(self):
+        """Merge the on-disk store if another worker has rewritten it."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        with self.lock:
+            if mtime == self.loaded_mtime:
+                return
+            try:
+                with open(self.path) as f:
+                    stored = json.load(f)
+            except (IOError, OSError, ValueError):
+                logger.warning("Ignoring unreadable metadata cache %s",
+                               self.path)
+                stored = {}
+            for name, entry in stored.items():
+                if name not in self.entries:
+                    self.entries[name] = entry
+            self.loaded_mtime = mtime
+            self._evict()
+
+    def lookup(self, name, st):
+        """Return the cached descriptor fields of name or None."""
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None and entry['key'] == self.stat_key(st):
+                self.entries[name] = entry
+                inc(self.METRIC, datastore=self.dir, result='hit')
+                return entry['desc']
+            if entry is not None:
+                self.dirty = True
+            inc(self.METRIC, datastore=self.dir, result='miss')
+            return None
+
+    def store(self, name, st, desc):
+        with self.lock:
+            self.entries.pop(name, None)
+            self.entries[name] = {
+                'key': self.stat_key(st),
+                'desc': dict((k, desc.get(k)) for k in self.FIELDS)}
+            self.dirty = True
+            self._evict()
+
+    def invalidate(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.dirty = True
+
+    def prune(self, names):
+        """Drop entries of files not listed in names."""
+        names = set(names)
+        with self.lock:
+            for name in [n for n in self.entries if n not in names]:
+                del self.entries[name]
+                self.dirty = True
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.dirty = True
+
+    def save(self):
+        """Atomically write the cache to the datastore if changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            try:
+                state_dir = os.path.dirname(self.path)
+                if not os.path.isdir(state_dir):
+                    os.mkdir(state_dir)
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.entries, f)
+                os.rename(tmp_path, self.path)
+                self.loaded_mtime = os.stat(self.path).st_mtime
+                self.dirty = False
+            except (IOError, OSError):
+                logger.warning("Cannot save metadata cache %s",
+                               self.path, exc_info=True)
+
+    def stats(self, worker):
+        """Return the hits and misses of every process of worker that
+        spooled its metrics, and the number of entries."""
+        flush(worker, force=True)
+        merged = collect([worker])
+        with self.lock:
+            return {'hits': merged.total(self.METRIC, datastore=self.dir,
+                                         result='hit'),
+                    'misses': merged.total(self.METRIC, datastore=self.dir,
+                                           result='miss'),
+                    'entries': len(self.entries)}
+
+
 class Disk(object):
 
     ''' Storage driver DISK object.
@@ -59,12 +212,21 @@ class Disk(object):
         self.base_name = base_name
 
     @property
-    def checksum(self, blocksize=65536):
-        hash = md5()
-        with open(self.get_path(), "rb") as f:
-            for block in iter(lambda: f.read(blocksize), ""):
-                hash.update(block)
-        return hash.hexdigest()
+    def checksum(self):
+        return self.get_checksum()
+
+    def get_checksum(self, algorithm=None):
+        """Return the digest of the image, hashing it only if it
+        changed since the digest was saved."""
+        algorithm = algorithm or default_algorithm
+        path = self.get_path()
+        digest = read_sidecar(path, self.get_state_dir(), self.name,
+                              algorithm)
+        if digest is None:
+            digest = file_checksum(path, algorithm)
+            write_sidecar(path, self.get_state_dir(), self.name,
+                          algorithm, digest)
+        return digest
 
     @classmethod
     def deserialize(cls, desc):
@@ -94,16 +256,27 @@ class Disk(object):
         """Get absolute path for disk's base image."""
         return os.path.realpath(self.dir + '/' + self.base_name)
 
+    def get_state_dir(self):
+        """Get the driver's bookkeeping directory of the datastore."""
+        return os.path.join(self.dir, state_directory)
+
     def __unicode__(self):
         return u'%s %s %s %s' % (self.get_path(), self.format,
                                  self.size, self.get_base())
 
+    @staticmethod
+    def info_options():
+        # read images in use by a VM without taking their lock
+        return ['-U'] if qemu_img()['force_share'] else []
+
     @classmethod
     def get_legacy(cls, dir, name):
         ''' Create disk from path
         '''
         path = os.path.realpath(dir + '/' + name)
-        output = subprocess.check_output(['qemu-img', 'info', path])
+        cmdline = ['qemu-img', 'info'] + cls.info_options() + [path]
+        with subprocess_timer(cmdline):
+            output = subprocess.check_output(cmdline)
 
         type = 'normal'
         base_name = None
@@ -125,10 +298,16 @@ class Disk(object):
     def get_new(cls, dir, name):
         """Create disk from path."""
         path = os.path.realpath(dir + '/' + name)
-        output = subprocess.check_output(
-            ['qemu-img', 'info', '--output=json', path])
+        cmdline = (['qemu-img', 'info', '--output=json'] +
+                   cls.info_options() + [path])
+        with subprocess_timer(cmdline):
+            output = subprocess.check_output(cmdline)
         disk_info = json.loads(output)
-        name = name
+        return cls.from_info(dir, name, disk_info)
+
+    @classmethod
+    def from_info(cls, dir, name, disk_info):
+        """Create disk from `qemu-img info --output=json` style dict."""
         format = disk_info.get('format')
         size = disk_info.get('virtual-size')
         actual_size = disk_info.get('actual-size')
@@ -144,13 +323,42 @@ class Disk(object):
         return Disk(dir, name, format, type, size, base_name, actual_size)
 
     @classmethod
-    def get(cls, dir, name):
-        from platform import dist
-        if dist()[1] < '14.04':
+    def get_native(cls, dir, name):
+        """Create disk from path by reading the image header.
+        Return None if qemu-img has to be used."""
+        path = os.path.realpath(dir + '/' + name)
+        disk_info = read_image_info(path)
+        if disk_info is None:
+            return None
+        return cls.from_info(dir, name, disk_info)
+
+    @classmethod
+    def probe(cls, dir, name):
+        """Create disk from path, running qemu-img only when needed."""
+        disk = cls.get_native(dir, name)
+        if disk is not None:
+            return disk
+        if not qemu_img()['json']:
             return Disk.get_legacy(dir, name)
         else:
             return Disk.get_new(dir, name)
 
+    @classmethod
+    def get_cached(cls, cache, dir, name):
+        """Create disk from path, probing only new or modified files."""
+        st = os.stat(os.path.realpath(dir + '/' + name))
+        desc = cache.lookup(name, st)
+        if desc is not None:
+            return Disk(dir, name, **desc)
+        disk = cls.probe(dir, name)
+        cache.store(name, st, disk.get_desc())
+        return disk
+
+    @classmethod
+    def get(cls, dir, name):
+        # the cache is saved by the next listing, not for every image
+        return cls.get_cached(DiskMetadataCache.for_dir(dir), dir, name)
+
     def create(self):
         """ Creating new image format specified at self.format.
             self.format can be "qcow2-normal"
@@ -170,19 +378,22 @@ class Disk(object):
                    self.get_path(),
                    str(self.size)]
         logging.info("Create file: %s " % cmdline)
-        # Call subprocess
-        subprocess.check_output(cmdline)
+        with Operation('create'):
+            # Call subprocess
+            with subprocess_timer(cmdline):
+                subprocess.check_output(cmdline)
+            ChainIndex.for_dir(self.dir).add(self.name)
 
-    def check_valid_image(self):
-        """Check wether the downloaded image is valid.
-        Set the proper type for valid images."""
+    def check_valid_image(self, path=None):
+        """Check wether the downloaded image (at path, by default the
+        disk's) is valid. Set the proper type for valid images."""
         format_map = [
             ("qcow", "qcow2-norm"),
             ("iso", "iso"),
             ("x86 boot sector", "iso")
         ]
         with magic.Magic() as m:
-            ftype = m.id_filename(self.get_path())
+            ftype = m.id_filename(path or self.get_path())
             logger.debug("Downloaded file type is: %s", ftype)
             for file_type, disk_format in format_map:
                 if file_type in ftype.lower():
@@ -190,99 +401,325 @@ class Disk(object):
                     return True
         return False
 
-    def download(self, task, url, parent_id=None):  # noqa
-        """Download image from url."""
-        disk_path = self.get_path()
-        logger.info("Downloading image from %s to %s", url, disk_path)
-        r = requests.get(url, stream=True)
-        if r.status_code != 200:
-            raise Exception("Invalid response status code: %s at %s" %
-                            (r.status_code, url))
-
-        if task.is_aborted():
-            raise AbortException()
+    def get_journal_path(self):
+        """Get path of the resumable download journal."""
+        return os.path.join(self.get_state_dir(), journal_directory,
+                            self.name)
+
+    def get_part_path(self):
+        """Get path of the image while it is downloaded."""
+        return self.get_journal_path() + '.part'
+
+    def download(self, task, url, parent_id=None,  # noqa
+                 checksum_algorithm=None):
+        """Download image from url.
+        The image is hashed with checksum_algorithm while it is written.
+        Sources accepting byte ranges are fetched over several
+        connections, and a failed download is resumed by the next try.
+        The image is written to a part file in the state directory and
+        moved into the datastore once it is found valid."""
+        with Operation('download') as op:
+            disk_path = self.get_path()
+            part_path = self.get_part_path()
+            logger.info("Downloading image from %s to %s", url, disk_path)
+            cache = TemplateCache.for_dir(self.dir)
+            entry = cache.lookup(url) if cache is not None else None
+            try:
+                r = http_pool().get(url, aborted=task.is_aborted, stream=True,
+                                    headers=conditional_headers(entry))
+            except AbortRequest:
+                raise AbortException()
+            try:
+                if r.status_code == 304 and entry is not None:
+                    r.close()
+                    if self.download_from_cache(task, cache, entry, parent_id,
+                                                checksum_algorithm):
+                        op.outcome = 'cached'
+                        return
+                    try:
+                        r = http_pool().get(url, aborted=task.is_aborted,
+                                            stream=True)
+                    except AbortRequest:
+                        raise AbortException()
+                if r.status_code != 200:
+                    raise Exception("Invalid response status code: %s at %s" %
+                                    (r.status_code, url))
+
+                if task.is_aborted():
+                    raise AbortException()
+                if parent_id is None:
+                    parent_id = task.request.id
+                clen = int(r.headers.get('content-length', maximum_size))
+                if clen > maximum_size:
+                    raise FileTooBig()
+                chunks = r.iter_content(chunk_size=256 * 1024)
+                head = next(chunks, b'')
+                compression = detect(url, r.headers.get('content-type'), head)
+                ranged = (compression is None and supports_ranges(r) and
+                          clen >= 2 * piece_size)
+                hasher = HashStage(checksum_algorithm)
+                if not os.path.isdir(os.path.dirname(part_path)):
+                    os.makedirs(os.path.dirname(part_path))
+                try:
+                    with ProgressReporter(task, parent_id, clen) as progress:
+                        if ranged:
+                            r.close()
+                            self.download_ranges(progress, url, clen,
+                                                 validator(r), hasher,
+                                                 part_path, op=op)
+                        else:
+                            if (compression is None and
+                                    'content-length' in r.headers):
+                                length = clen
+                            else:
+                                length = None
+                            self.download_stream(progress,
+                                                 chain([head], chunks),
+                                                 compression, hasher, length,
+                                                 part_path, op=op)
+                    digest = hasher.hexdigest()
+                    op.add_time('hash', hasher.seconds)
+                except AbortException:
+                    # Cleanup file:
+                    hasher.close()
+                    op.outcome = 'aborted'
+                    if os.path.exists(part_path):
+                        os.unlink(part_path)
+                    if ranged and os.path.exists(self.get_journal_path()):
+                        os.unlink(self.get_journal_path())
+                    logger.info("Download %s aborted %s removed.",
+                                url, part_path)
+                except FileTooBig:
+                    hasher.close()
+                    os.unlink(part_path)
+                    raise Exception("%s file is too big. Maximum size "
+                                    "is %s" % (url, maximum_size))
+                except:
+                    hasher.close()
+                    if ranged:
+                        logger.error("Download %s failed, %s kept for "
+                                     "resuming.", url, part_path)
+                    else:
+                        if os.path.exists(part_path):
+                            os.unlink(part_path)
+                        logger.error("Download %s failed, %s removed.",
+                                     url, part_path)
+                    raise
+                else:
+                    if not self.check_valid_image(part_path):
+                        os.unlink(part_path)
+                        raise Exception("Invalid file format. Only qcow and "
+                                        "iso files are allowed. Image from: "
+                                        "%s" % url)
+                    os.rename(part_path, disk_path)
+                    self.size = Disk.get(self.dir, self.name).size
+                    logger.debug("Download finished %s (%s bytes)",
+                                 self.name, self.size)
+                    write_sidecar(disk_path, self.get_state_dir(), self.name,
+                                  hasher.algorithm, digest)
+                    ChainIndex.for_dir(self.dir).add(self.name)
+                    if cache is not None:
+                        cache.store(url, validator(r), disk_path,
+                                    hasher.algorithm, digest, self.format)
+            finally:
+                r.close()
+
+    def download_from_cache(self, task, cache, entry, parent_id=None,
+                            checksum_algorithm=None):
+        """Copy the cached, already validated image of entry to the
+        disk. Return False if it is no longer cached."""
         if parent_id is None:
             parent_id = task.request.id
-        chunk_size = 256 * 1024
-        ext = url.split('.')[-1].lower()
-        if ext == 'gz':
-            decompressor = decompressobj(16 + MAX_WBITS)
-            # undocumented zlib feature http://stackoverflow.com/a/2424549
-        elif ext == 'bz2':
-            decompressor = BZ2Decompressor()
-        clen = int(r.headers.get('content-length', maximum_size))
-        if clen > maximum_size:
-            raise FileTooBig()
-        percent = 0
+        total = os.path.getsize(entry['path'])
         try:
-            with open(disk_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    if ext in ('gz', 'bz2'):
-                        chunk = decompressor.decompress(chunk)
-                    f.write(chunk)
-                    actsize = f.tell()
-                    if actsize > maximum_size:
-                        raise FileTooBig()
-                    new_percent = min(100, round(actsize * 100.0 / clen))
-                    if new_percent > percent:
-                        percent = new_percent
-                        if not task.is_aborted():
-                            task.update_state(
-                                task_id=parent_id,
-                                state=task.AsyncResult(parent_id).state,
-                                meta={'size': actsize, 'percent': percent})
-                        else:
-                            raise AbortException()
-                if ext == 'gz':
-                    f.write(decompressor.flush())
-                f.flush()
-            self.size = Disk.get(self.dir, self.name).size
-            logger.debug("Download finished %s (%s bytes)",
-                         self.name, self.size)
-        except AbortException:
-            # Cleanup file:
-            os.unlink(disk_path)
-            logger.info("Download %s aborted %s removed.",
-                        url, disk_path)
-        except FileTooBig:
-            os.unlink(disk_path)
-            raise Exception("%s file is too big. Maximum size "
-                            "is %s" % url, maximum_size)
-        except:
-            os.unlink(disk_path)
-            logger.error("Download %s failed, %s removed.",
-                         url, disk_path)
-            raise
+            with ProgressReporter(task, parent_id, total) as progress:
+                method = cache.clone(entry, self.get_path(),
+                                     on_progress=progress.update,
+                                     aborted=lambda: progress.aborted)
+        except AbortCopy:
+            os.unlink(self.get_path())
+            logger.info("Copy of %s from the template cache aborted.",
+                        self.name)
+            raise AbortException()
+        if method is None:
+            return False
+        logger.info("Copied %s from the template cache with %s.",
+                    self.name, method)
+        self.format = entry['format']
+        self.size = Disk.get(self.dir, self.name).size
+        if entry['algorithm'] == (checksum_algorithm or default_algorithm):
+            write_sidecar(self.get_path(), self.get_state_dir(), self.name,
+                          entry['algorithm'], entry['digest'])
+        ChainIndex.for_dir(self.dir).add(self.name)
+        return True
+
+    def download_stream(self, progress, chunks, compression, hasher,
+                        length=None, path=None, op=None):
+        """Decode the downloaded chunks straight into the disk, or the
+        file at path. The file is preallocated if its final length is
+        known. Return the number of bytes written."""
+        op = op or Operation('download')
+        decoder = get_decoder(compression)
+        limiter = rate_limiter(self.dir, 'download')
+        received = 0
+        with open(path or self.get_path(), 'wb') as f:
+            if (length is not None and preallocate_downloads and
+                    filesystem(self.dir)['fallocate']):
+                preallocate(f, length)
+            writer = SparseWriter(f)
+            for chunk in op.timed('network', chunks):
+                received += len(chunk)
+                if limiter is not None:
+                    with op.phase('throttle'):
+                        limiter.consume(len(chunk))
+                for block in op.timed('decompress', decoder.decode(chunk)):
+                    with op.phase('write'):
+                        self.write_block(writer, block, hasher)
+                actsize = writer.tell()
+                if actsize > maximum_size:
+                    raise FileTooBig()
+                progress.update(actsize, received)
+                if progress.aborted:
+                    raise AbortException()
+            for block in op.timed('decompress', decoder.finish()):
+                with op.phase('write'):
+                    self.write_block(writer, block, hasher)
+            writer.finish()
+            if writer.skipped:
+                logger.debug("Skipped writing %s zero bytes of %s.",
+                             writer.skipped, self.name)
+            op.moved(received, 'received')
+            op.moved(writer.tell() - writer.skipped, 'written')
+            return writer.tell()
+
+    @staticmethod
+    def write_block(writer, block, hasher):
+        if block is RESET:
+            writer.reset()
+            hasher.reset()
         else:
-            if ext == 'zip' and is_zipfile(disk_path):
-                task.update_state(
-                    task_id=parent_id,
-                    state=task.AsyncResult(parent_id).state,
-                    meta={'size': actsize, 'extracting': 'zip',
-                          'percent': 99})
-                self.extract_iso_from_zip(disk_path)
-            if not self.check_valid_image():
-                os.unlink(disk_path)
-                raise Exception("Invalid file format. Only qcow and "
-                                "iso files are allowed. Image from: %s" % url)
-
-    def extract_iso_from_zip(self, disk_path):
-        with ZipFile(disk_path, 'r') as z:
-            isos = z.namelist()
-            if len(isos) != 1:
-                isos = [i for i in isos
-                        if i.lower().endswith('.iso')]
-            if len(isos) == 1:
-                logger.info('Unzipping %s started.', disk_path)
-                f = open(disk_path + '~', 'wb')
-                zf = z.open(isos[0])
-                with zf, f:
-                    copyfileobj(zf, f)
-                    f.flush()
-                move(disk_path + '~', disk_path)
-            else:
-                logger.info("Extracting %s failed, keeping original.",
-                            disk_path)
+            writer.write(block)
+            hasher.update(block)
+
+    def download_ranges(self, progress, url, clen, source_validator, hasher,
+                        path=None, blocksize=1024 * 1024, op=None):
+        """Fetch url into the disk, or the file at path, with parallel
+        range requests. Completed pieces are hashed in order as soon as
+        all pieces before them are done."""
+        op = op or Operation('download')
+        disk_path = path or self.get_path()
+        limiter = rate_limiter(self.dir, 'download')
+        # only where fallocate does not fall back to writing zeros
+        allocate = (preallocate_downloads and
+                    filesystem(self.dir)['fallocate'])
+        download = RangedDownload(url, disk_path, self.get_journal_path(),
+                                  clen, source_validator,
+                                  throttle=limiter and limiter.consume,
+                                  allocate=allocate)
+        pending = set()
+        state = {'next': 0, 'readback': 0}
+
+        def on_piece(index):
+            pending.add(index)
+            while state['next'] in pending:
+                pending.remove(state['next'])
+                start, end = download.piece_range(state['next'])
+                started = time()
+                with open(disk_path, 'rb') as f:
+                    f.seek(start)
+                    left = end - start + 1
+                    while left > 0:
+                        block = f.read(min(blocksize, left))
+                        if not block:
+                            break
+                        hasher.update(block)
+                        left -= len(block)
+                state['readback'] += time() - started
+                state['next'] += 1
+
+        def on_progress(actsize):
+            progress.update(actsize)
+            if progress.aborted:
+                raise AbortException()
+
+        started = time()
+        try:
+            download.run(on_progress, on_piece)
+        finally:
+            # the pieces are fetched and written by the connections
+            op.add_time('network', time() - started - state['readback'])
+            op.add_time('readback', state['readback'])
+        op.moved(clen, 'received')
+        op.moved(clen, 'written')
+
+    def get_export_path(self):
+        """Get path of the flattened image while it is exported."""
+        return os.path.join(self.get_state_dir(), export_directory,
+                            '%s.%d' % (self.name, os.getpid()))
+
+    def flatten(self, task, path, parent_id):
+        """Convert the disk and its backing chain into one image at
+        path. Return False if aborted."""
+        options = merge_options(self.dir)
+        options.update(convert_limits(self.dir))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        expire_exports(os.path.dirname(path))
+        try:
+            with ProgressReporter(task, parent_id, 100,
+                                  min_bytes=0) as progress:
+                convert(self.get_path(), path, self.format, options,
+                        on_progress=lambda percent: progress.update(
+                            0, percent, phase='flatten'),
+                        aborted=lambda: progress.aborted)
+        except AbortConvert:
+            return False
+        return True
+
+    def export(self, task, target, compression='gzip', parent_id=None):
+        """Stream the image to target, a local path or an http(s) URL
+        accepting PUT, compressed with compression ('gzip', 'zstd' or
+        None). Only the data extents of the file are read. A snapshot is
+        flattened with its backing chain first, so the export does not
+        refer to base images of this host.
+        Return the number of bytes sent, None if aborted."""
+        if task.is_aborted():
+            raise AbortException()
+        if parent_id is None:
+            parent_id = task.request.id
+        disk_path = self.get_path()
+        flat_path = self.get_export_path() if self.base_name else None
+        with Operation('export') as op:
+            logger.info("Exporting %s to %s", disk_path, target)
+            exporter = None
+            try:
+                if flat_path is not None:
+                    with op.phase('flatten'):
+                        if not self.flatten(task, flat_path, parent_id):
+                            raise AbortExport()
+                exporter = Exporter(flat_path or disk_path, compression)
+                with ProgressReporter(task, parent_id, os.path.getsize(
+                        flat_path or disk_path)) as progress:
+                    def on_progress(position):
+                        progress.update(exporter.sent_bytes, position,
+                                        phase='export')
+                    exporter.export(target, on_progress,
+                                    aborted=lambda: progress.aborted)
+            except AbortExport:
+                op.outcome = 'aborted'
+                logger.info("Export of %s to %s aborted.", disk_path, target)
+                return None
+            finally:
+                if flat_path is not None and os.path.exists(flat_path):
+                    os.unlink(flat_path)
+                if exporter is not None:
+                    for phase, seconds in exporter.seconds.items():
+                        op.add_time(phase, seconds)
+                    op.moved(exporter.read_bytes, 'read')
+                    op.moved(exporter.sent_bytes, 'sent')
+            logger.debug("Export finished %s (%s bytes read, %s sent)",
+                         self.name, exporter.read_bytes, exporter.sent_bytes)
+            return exporter.sent_bytes
 
     def snapshot(self):
         ''' Creating qcow2 snapshot with base image.
@@ -297,106 +734,85 @@ class Disk(object):
         if not os.path.isfile(self.get_base()):
             raise Exception('Image Base does not exists: %s' % self.get_base())
         # Build list of Strings as command parameters
-        if self.format == 'iso':
-            os.symlink(self.get_base(), self.get_path())
-        elif self.format == 'raw':
-            raise NotImplemented()
-        else:
-            cmdline = ['qemu-img',
-                       'create',
-                       '-b', self.get_base(),
-                       '-f', self.format,
-                       self.get_path()]
-            # Call subprocess
-            subprocess.check_output(cmdline)
+        with Operation('snapshot'):
+            if self.format == 'iso':
+                os.symlink(self.get_base(), self.get_path())
+            elif self.format == 'raw':
+                raise NotImplemented()
+            else:
+                pool = OverlayPool.for_dir(self.dir)
+                if pool is None or not pool.take(self.base_name,
+                                                 self.get_path(),
+                                                 self.format):
+                    cmdline = ['qemu-img',
+                               'create',
+                               '-b', self.get_base(),
+                               '-f', self.format,
+                               self.get_path()]
+                    # Call subprocess
+                    with subprocess_timer(cmdline):
+                        subprocess.check_output(cmdline)
+            ChainIndex.for_dir(self.dir).add(self.name, self.base_name)
 
     def merge_disk_with_base(self, task, new_disk, parent_id=None):
-        proc = None
         try:
-            cmdline = [
-                'qemu-img', 'convert', self.get_path(),
-                '-O', new_disk.format, new_disk.get_path()]
             # Call subprocess
             logger.debug(
                 "Merging %s into %s.", self.get_path(),
                 new_disk.get_path())
-            percent = 0
             diff_disk = Disk.get(self.dir, self.name)
-            base_disk = Disk.get(self.dir, self.base_name)
-            clen = min(base_disk.actual_size + diff_disk.actual_size,
-                       diff_disk.size)
-            output = new_disk.get_path()
-            proc = subprocess.Popen(cmdline)
-            while True:
-                if proc.poll() is not None:
-                    break
-                try:
-                    actsize = os.path.getsize(output)
-                except OSError:
-                    actsize = 0
-                new_percent = min(100, round(actsize * 100.0 / clen))
-                if new_percent > percent:
-                    percent = new_percent
-                    if not task.is_aborted():
-                        task.update_state(
-                            task_id=parent_id,
-                            state=task.AsyncResult(parent_id).state,
-                            meta={'size': actsize, 'percent': percent})
-                    else:
-                        logger.warning(
-                            "Merging new disk %s is aborted by user.",
-                            new_disk.get_path())
-                        raise AbortException()
-                sleep(1)
-        except AbortException:
-            proc.terminate()
+            chain = ChainIndex.for_dir(self.dir).ancestors(self.name)
+            clen = min(sum(Disk.get(self.dir, name).actual_size
+                           for name in chain or [self.base_name]) +
+                       diff_disk.actual_size, diff_disk.size)
+            options = merge_options(new_disk.dir)
+            options.update(convert_limits(new_disk.dir))
+            progress = ProgressReporter(task, parent_id, 100, min_bytes=0)
+            with progress:
+                convert(self.get_path(), new_disk.get_path(),
+                        new_disk.format, options,
+                        on_progress=lambda percent: progress.update(
+                            int(clen * percent / 100), percent),
+                        aborted=lambda: progress.aborted)
+        except AbortConvert:
             logger.warning("Aborted merge job, removing %s",
                            new_disk.get_path())
             os.unlink(new_disk.get_path())
 
         except:
-            if proc:
-                proc.terminate()
             logger.exception("Unknown error occured, removing %s ",
                              new_disk.get_path())
-            os.unlink(new_disk.get_path())
+            if os.path.exists(new_disk.get_path()):
+                os.unlink(new_disk.get_path())
             raise
 
-    def merge_disk_without_base(self, task, new_disk, parent_id=None,
-                                length=1024 * 1024):
+    def merge_disk_without_base(self, task, new_disk, parent_id=None):
+        limiter = rate_limiter(new_disk.dir, 'merge')
+        features = filesystem(new_disk.dir)
+        engine = CopyEngine(use_reflink=features['reflink'],
+                            use_copy_file_range=features['copy_file_range'])
         try:
-            fsrc = open(self.get_path(), 'rb')
-            fdst = open(new_disk.get_path(), 'wb')
-            clen = self.size
-            actsize = 0
-            percent = 0
-            with fsrc, fdst:
-                while True:
-                    buf = fsrc.read(length)
-                    if not buf:
-                        break
-                    fdst.write(buf)
-                    actsize += len(buf)
-                    new_percent = min(100, round(actsize * 100.0 / clen))
-                    if new_percent > percent:
-                        percent = new_percent
-                        if not task.is_aborted():
-                            task.update_state(
-                                task_id=parent_id,
-                                state=task.AsyncResult(parent_id).state,
-                                meta={'size': actsize, 'percent': percent})
-                        else:
-                            logger.warning(
-                                "Merging new disk %s is aborted by user.",
-                                new_disk.get_path())
-                            raise AbortException()
-        except AbortException:
+            progress = ProgressReporter(task, parent_id,
+                                        os.path.getsize(self.get_path()))
+            with progress:
+                method = engine.copy(
+                    self.get_path(), new_disk.get_path(),
+                    on_progress=progress.update,
+                    aborted=lambda: progress.aborted,
+                    throttle=limiter and limiter.consume)
+            logger.debug("Copied %s to %s with %s.", self.get_path(),
+                         new_disk.get_path(), method)
+        except AbortCopy:
+            logger.warning(
+                "Merging new disk %s is aborted by user.",
+                new_disk.get_path())
             logger.warning("Aborted remove %s", new_disk.get_path())
             os.unlink(new_disk.get_path())
         except:
             logger.exception("Unknown error occured removing %s ",
                              new_disk.get_path())
-            os.unlink(new_disk.get_path())
+            if os.path.exists(new_disk.get_path()):
+                os.unlink(new_disk.get_path())
             raise
 
     def merge(self, task, new_disk, parent_id=None):
@@ -405,24 +821,41 @@ class Disk(object):
 
         if task.is_aborted():
             raise AbortException()
+        if parent_id is None:
+            parent_id = task.request.id
 
         # Check if file already exists
         if os.path.isfile(new_disk.get_path()):
             raise Exception('File already exists: %s' % self.get_path())
 
-        if self.format == "iso":
-            os.symlink(self.get_path(), new_disk.get_path())
-        elif self.base_name:
-            self.merge_disk_with_base(task, new_disk, parent_id)
-        else:
-            self.merge_disk_without_base(task, new_disk, parent_id)
+        with Operation('merge') as op:
+            if self.format == "iso":
+                os.symlink(self.get_path(), new_disk.get_path())
+            elif self.base_name:
+                with op.phase('convert'):
+                    self.merge_disk_with_base(task, new_disk, parent_id)
+            else:
+                with op.phase('copy'):
+                    self.merge_disk_without_base(task, new_disk, parent_id)
+            if not os.path.lexists(new_disk.get_path()):
+                op.outcome = 'aborted'
+                return
+            op.moved(os.lstat(new_disk.get_path()).st_blocks * 512,
+                     'written')
+            ChainIndex.for_dir(new_disk.dir).add(new_disk.name)
 
     def delete(self):
         """ Delete file. """
         if os.path.isfile(self.get_path()):
             os.unlink(self.get_path())
+        remove_sidecars(self.get_state_dir(), self.name)
+        pool = OverlayPool.for_dir(self.dir)
+        if pool is not None:
+            pool.clear(self.name)
+        ChainIndex.for_dir(self.dir, build=False).remove(self.name)
 
     @classmethod
     def list(cls, dir):
-        """ List all files in <dir> directory."""
-        return [cls.get(dir, file) for file in os.listdir(dir)]
+        """ List all disk images in <dir> directory."""
+        from inventory import scan
+        return scan(dir)['disks']
@@ -0,0 +1,143 @@
+""" Download engine of a worker process.
+
+    Downloads mostly wait on the network, so instead of running in the
+    task that asked for them they are handed to a bounded thread pool of
+    the process, which runs DOWNLOAD_ENGINE_WORKERS of them at a time
+    over the shared HTTP connection pool. The task only waits for its
+    download, polling its abort flag; a download aborted while queued
+    never starts, one aborted while running stops like before, and
+    progress is still reported as the task's state.
+
+    Under the default prefork pool every process runs one task, so the
+    engine runs one download per process. With SLOW_POOL=threads the
+    slow worker runs SLOW_CONCURRENCY tasks as threads of one process,
+    and many imports share the process, its connections and the per-host
+    limits, with the engine bounding the transfers. That pool does not
+    enforce the time limits of tasks.
+"""
+import os
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from progress import abort_poll_interval
+
+logger = logging.getLogger(__name__)
+
+engine_workers = int(os.getenv("DOWNLOAD_ENGINE_WORKERS", 8))
+
+
+class TaskRequest(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class TaskContext(object):
+
+    """ The parts of a task a download uses, bound to the task's request
+        so they work in engine threads; task.request is local to the
+        thread running the task.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.name = task.name
+        self.request = TaskRequest(task.request.id)
+
+    def is_aborted(self):
+        return self.task.is_aborted(task_id=self.request.id)
+
+    def update_state(self, **kwargs):
+        kwargs.setdefault('task_id', self.request.id)
+        return self.task.update_state(**kwargs)
+
+    def AsyncResult(self, task_id):
+        return self.task.AsyncResult(task_id)
+
+
+class Job(object):
+
+    def __init__(self, function, context):
+        self.function = function
+        self.context = context
+        self.lock = threading.Lock()
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DownloadEngine(object):
+
+    """ The download threads of a process. run(task, function) calls
+        function(context) on an engine thread, where context stands for
+        task, and returns what it returns.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, workers=engine_workers):
+        self.pid = os.getpid()
+        self.workers = workers
+        self.pool = ThreadPool(processes=workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    @classmethod
+    def for_process(cls):
+        """Return the engine of this process, threads do not survive a
+        fork."""
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls()
+            return cls._instance
+
+    def execute(self, job):
+        with job.lock:
+            if job.cancelled:
+                return
+            job.started = True
+        try:
+            job.result = job.function(job.context)
+        except BaseException as e:
+            job.error = e
+        finally:
+            with self.lock:
+                self.pending -= 1
+            job.done.set()
+
+    def run(self, task, function):
+        """ Run function(context) on the engine and wait for it. If the
+            task is aborted while the job is queued it is dropped and
+            None returned.
+        """
+        job = Job(function, TaskContext(task))
+        with self.lock:
+            self.pending += 1
+            if self.pending > self.workers:
+                logger.info("Download of task %s queued behind %d others.",
+                            job.context.request.id,
+                            self.pending - self.workers)
+        self.pool.apply_async(self.execute, (job, ))
+        while not job.done.wait(abort_poll_interval):
+            if job.started or not job.context.is_aborted():
+                continue
+            with job.lock:
+                if job.started:
+                    continue
+                job.cancelled = True
+            with self.lock:
+                self.pending -= 1
+            logger.info("Queued download of task %s aborted.",
+                        job.context.request.id)
+            return None
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+
+def download_engine():
+    return DownloadEngine.for_process()
@@ -0,0 +1,293 @@
+""" Resumable, multi-connection HTTP downloads.
+
+    When the server accepts byte ranges the image is split into pieces
+    which are fetched over several connections straight into their place
+    in a preallocated file. Completed pieces are recorded in a journal
+    under the datastore's state directory, so a retried task continues
+    where the previous attempt stopped. Journals and partial images not
+    touched for DOWNLOAD_EXPIRY seconds are removed by the reclaimer.
+"""
+import os
+import json
+import logging
+import threading
+from time import time
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+import requests
+
+from httppool import AbortRequest, http_pool
+from sparsewriter import SparseWriter, preallocate
+
+logger = logging.getLogger(__name__)
+
+download_connections = int(os.getenv("DOWNLOAD_CONNECTIONS", 4))
+piece_size = int(os.getenv("DOWNLOAD_PIECE_SIZE", 16 * 1024 * 1024))
+piece_retries = int(os.getenv("DOWNLOAD_PIECE_RETRIES", 3))
+download_expiry = float(os.getenv("DOWNLOAD_EXPIRY", 2 * 24 * 3600))
+journal_directory = "downloads"
+journal_interval = 1.0
+
+
+def supports_ranges(response):
+    """Whether the rest of response's entity can be fetched by ranges."""
+    headers = response.headers
+    return (headers.get('accept-ranges', '').lower() == 'bytes' and
+            headers.get('content-length', '').isdigit() and
+            headers.get('content-encoding', 'identity') == 'identity')
+
+
+def validator(response):
+    headers = response.headers
+    return {'etag': headers.get('etag'),
+            'last-modified': headers.get('last-modified')}
+
+
+def expire_downloads(state_dir, max_age=download_expiry):
+    """Remove the journals and partial images of downloads abandoned
+    for max_age seconds. Return the number of bytes freed."""
+    directory = os.path.join(state_dir, journal_directory)
+    if not os.path.isdir(directory):
+        return 0
+    freed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+            if time() - st.st_mtime < max_age:
+                continue
+            os.unlink(path)
+        except OSError:
+            continue  # removed or resumed meanwhile
+        logger.info("Removed abandoned download %s.", path)
+        freed += st.st_blocks * 512
+    return freed
+
+
+class StopDownload(Exception):
+    pass
+
+
+class RangedDownload(object):
+
+    """ Fetch url into path with parallel range requests.
+        Call run() from the thread which reports progress; the pieces
+        are downloaded by worker threads. The file is preallocated if
+        allocate is set.
+    """
+
+    def __init__(self, url, path, journal_path, length, validator,
+                 connections=None, piece_size=piece_size, throttle=None,
+                 allocate=False):
+        self.url = url
+        self.path = path
+        self.journal_path = journal_path
+        self.length = length
+        self.validator = validator
+        self.connections = connections or download_connections
+        self.piece_size = piece_size
+        # throttle(size) is called for each chunk received, and may sleep
+        self.throttle = throttle
+        self.allocate = allocate
+        self.pieces = (length + piece_size - 1) // piece_size
+        self.done = set()
+        # pieces which may hold stale data, so their zeros are written
+        self.dirty = set()
+        self.received = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.closing = threading.Event()
+        self.pool = http_pool()
+
+    def piece_range(self, index):
+        start = index * self.piece_size
+        return start, min(start + self.piece_size, self.length) - 1
+
+    def load_journal(self):
+        """Restore completed pieces if the journal matches the source."""
+        try:
+            with open(self.journal_path) as f:
+                journal = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if (journal.get('url') != self.url or
+                journal.get('length') != self.length or
+                journal.get('piece_size') != self.piece_size or
+                journal.get('validator') != self.validator or
+                not any(self.validator.values())):
+            logger.info("Source of %s changed, restarting download.",
+                        self.path)
+            return False
+        try:
+            if os.path.getsize(self.path) != self.length:
+                return False
+        except OSError:
+            return False
+        self.done = set(journal.get('done', []))
+        self.dirty = set(range(self.pieces)) - self.done
+        self.received = sum(self.piece_length(i) for i in self.done)
+        return True
+
+    def save_journal(self):
+        state = {'url': self.url,
+                 'length': self.length,
+                 'piece_size': self.piece_size,
+                 'validator': self.validator,
+                 'done': sorted(self.done)}
+        try:
+            journal_dir = os.path.dirname(self.journal_path)
+            if not os.path.isdir(journal_dir):
+                os.makedirs(journal_dir)
+            with open(self.journal_path + '~', 'w') as f:
+                json.dump(state, f)
+            os.rename(self.journal_path + '~', self.journal_path)
+        except (IOError, OSError):
+            logger.warning("Cannot save download journal %s",
+                           self.journal_path, exc_info=True)
+
+    def remove_journal(self):
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+
+    def piece_length(self, index):
+        start, end = self.piece_range(index)
+        return end - start + 1
+
+    def fetch_piece(self, f, index, chunk_size=256 * 1024):
+        start, end = self.piece_range(index)
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        try:
+            r = self.pool.get(self.url, aborted=self.stop.is_set,
+                              headers=headers, stream=True)
+        except AbortRequest:
+            raise StopDownload()
+        written = 0
+        try:
+            if r.status_code != 206:
+                raise Exception("Invalid response status code: %s at %s" %
+                                (r.status_code, self.url))
+            writer = SparseWriter(f)
+            if index in self.dirty:
+                writer.sparse = False
+            writer.seek(start)
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if self.stop.is_set():
+                    raise StopDownload()
+                chunk = chunk[:end - start + 1 - written]
+                if self.throttle is not None:
+                    self.throttle(len(chunk))
+                writer.write(chunk)
+                written += len(chunk)
+                with self.lock:
+                    self.received += len(chunk)
+            if written != end - start + 1:
+                raise IOError("Short read of piece %d of %s" %
+                              (index, self.url))
+            f.flush()
+        except:
+            with self.lock:
+                self.received -= written
+                self.dirty.add(index)
+            raise
+        finally:
+            r.close()
+
+    def worker(self, todo, results):
+        try:
+            with open(self.path, 'r+b') as f:
+                while not (self.stop.is_set() or self.closing.is_set()):
+                    try:
+                        index = todo.get_nowait()
+                    except Empty:
+                        return
+                    for attempt in range(piece_retries):
+                        try:
+                            self.fetch_piece(f, index)
+                            break
+                        except (requests.RequestException, IOError):
+                            if (self.stop.is_set() or
+                                    attempt == piece_retries - 1):
+                                raise
+                            logger.warning("Retrying piece %d of %s",
+                                           index, self.url, exc_info=True)
+                    results.put((index, None))
+        except StopDownload:
+            pass
+        except Exception as e:
+            results.put((None, e))
+
+    def drain(self, workers, results):
+        """Let the pieces in flight complete so a retry can skip them."""
+        self.closing.set()
+        for w in workers:
+            w.join()
+        while True:
+            try:
+                index, error = results.get_nowait()
+            except Empty:
+                break
+            if index is not None:
+                self.done.add(index)
+
+    def run(self, progress=None, on_piece=None):
+        """ Download the missing pieces.
+            progress(received_bytes) is called periodically and may raise
+            to stop the download; on_piece(index) is called for every
+            completed piece in the caller's thread.
+        """
+        if not self.load_journal():
+            self.done = set()
+            self.received = 0
+            with open(self.path, 'wb') as f:
+                if self.allocate:
+                    preallocate(f, self.length)
+                f.truncate(self.length)
+        else:
+            logger.info("Resuming download of %s: %d of %d pieces done.",
+                        self.path, len(self.done), self.pieces)
+        for index in sorted(self.done):
+            if on_piece is not None:
+                on_piece(index)
+        todo = Queue()
+        for index in range(self.pieces):
+            if index not in self.done:
+                todo.put(index)
+        results = Queue()
+        workers = [threading.Thread(target=self.worker, args=(todo, results))
+                   for i in range(min(self.connections, todo.qsize()))]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        last_save = time()
+        try:
+            while len(self.done) < self.pieces:
+                try:
+                    index, error = results.get(timeout=0.5)
+                except Empty:
+                    if not any(w.is_alive() for w in workers):
+                        raise Exception("Download workers of %s exited" %
+                                        self.url)
+                else:
+                    if error is not None:
+                        self.drain(workers, results)
+                        raise error
+                    self.done.add(index)
+                    if on_piece is not None:
+                        on_piece(index)
+                if progress is not None:
+                    progress(self.received)
+                if time() - last_save > journal_interval:
+                    self.save_journal()
+                    last_save = time()
+        except:
+            self.stop.set()
+            for w in workers:
+                w.join()
+            self.save_journal()
+            raise
+        for w in workers:
+            w.join()
+        self.remove_journal()
@@ -0,0 +1,232 @@
+""" Sparse-aware streaming export of disk images.
+
+    The image file is streamed, optionally compressed, to a local file
+    or to an HTTP(S) URL accepting PUT. Only the data extents of the
+    file are read, found with SEEK_DATA/SEEK_HOLE; holes are sent as
+    zeros, which compress to almost nothing. Blocks are compressed in
+    parallel on a thread pool, each into an independent gzip member or
+    zstd frame, so the result is an ordinary multi-member stream which
+    the download task can import again. Images with a backing file are
+    flattened into export_directory first by the caller; flattened
+    images of killed exports are removed after EXPORT_EXPIRY seconds.
+"""
+import os
+import zlib
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from time import time
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from copyengine import data_extents
+from httppool import AbortRequest, http_pool
+from sparsewriter import SparseWriter
+
+logger = logging.getLogger(__name__)
+
+export_workers = int(os.getenv("EXPORT_WORKERS", 4))
+export_block_size = int(os.getenv("EXPORT_BLOCK_SIZE", 4 * 1024 * 1024))
+export_directory = "exports"
+# the time limit of the export task
+export_expiry = float(os.getenv("EXPORT_EXPIRY", 5 * 3600))
+
+
+class AbortExport(Exception):
+    pass
+
+
+def expire_exports(directory, max_age=export_expiry):
+    """Remove the flattened images in directory left by exports killed
+    more than max_age seconds ago."""
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if time() - os.stat(path).st_mtime < max_age:
+                continue
+            os.unlink(path)
+        except OSError:
+            continue  # removed meanwhile
+        logger.info("Removed abandoned export %s.", path)
+
+
+def identity_encoder(level=None):
+    return lambda block: block
+
+
+def gzip_encoder(level=None):
+    level = 6 if level is None else level
+
+    def encode(block):
+        obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return obj.compress(block) + obj.flush()
+    return encode
+
+
+def zstd_encoder(level=None):
+    level = 3 if level is None else level
+
+    def encode(block):
+        # compressor objects can not be shared between threads
+        return zstandard.ZstdCompressor(level=level).compress(block)
+    return encode
+
+
+# name, content type, factory
+ENCODERS = [
+    (None, 'application/octet-stream', identity_encoder),
+    ('gzip', 'application/gzip', gzip_encoder),
+]
+if zstandard is not None:
+    ENCODERS.append(('zstd', 'application/zstd', zstd_encoder))
+
+
+def get_encoder(name, level=None):
+    """Return the block encoder and content type of compression name."""
+    for encoder_name, content_type, factory in ENCODERS:
+        if encoder_name == name:
+            return factory(level), content_type
+    raise Exception("Unsupported compression: %s" % name)
+
+
+def segments(fd, size, block_size=export_block_size):
+    """ Yield (offset, length, is_data) covering the file in blocks of
+        at most block_size bytes, holes and data separately.
+    """
+    position = 0
+    for start, length in list(data_extents(fd, size)) + [(size, 0)]:
+        for offset in range(position, start, block_size):
+            yield offset, min(block_size, start - offset), False
+        end = start + length
+        for offset in range(start, end, block_size):
+            yield offset, min(block_size, end - offset), True
+        position = end
+
+
+class Exporter(object):
+
+    """ Stream the file at path to a target. The blocks are read in
+        order by the calling thread and encoded by a pool of workers,
+        with at most two blocks per worker in flight.
+    """
+
+    def __init__(self, path, compression='gzip', level=None, workers=None,
+                 block_size=export_block_size):
+        self.path = path
+        self.compression = compression
+        self.encode, self.content_type = get_encoder(compression, level)
+        self.workers = workers or export_workers
+        self.block_size = block_size
+        self.zeros = {}
+        self.read_bytes = 0
+        self.sent_bytes = 0
+        self.seconds = {'read': 0, 'compress': 0, 'send': 0}
+
+    def encode_timed(self, block):
+        start = time()
+        data = self.encode(block)
+        return data, time() - start
+
+    def encoded_zeros(self, length):
+        if length not in self.zeros:
+            self.zeros[length] = self.encode(b'\0' * length)
+        return self.zeros[length]
+
+    def complete(self, entry):
+        end, length, result = entry
+        if result is None:
+            return self.encoded_zeros(length), end
+        data, seconds = result.get()
+        self.seconds['compress'] += seconds
+        return data, end
+
+    def encoded(self, aborted=None):
+        """Yield (data, end) of the encoded blocks in order."""
+        pool = ThreadPool(self.workers)
+        pending = deque()
+        try:
+            with open(self.path, 'rb') as f:
+                fd = f.fileno()
+                size = os.fstat(fd).st_size
+                for offset, length, is_data in segments(fd, size,
+                                                        self.block_size):
+                    if aborted is not None and aborted():
+                        raise AbortExport()
+                    result = None
+                    if is_data:
+                        start = time()
+                        f.seek(offset)
+                        block = f.read(length)
+                        self.seconds['read'] += time() - start
+                        self.read_bytes += len(block)
+                        result = pool.apply_async(self.encode_timed,
+                                                  (block, ))
+                    pending.append((offset + length, length, result))
+                    if len(pending) >= 2 * self.workers:
+                        yield self.complete(pending.popleft())
+            while pending:
+                yield self.complete(pending.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def chunks(self, on_progress=None, aborted=None):
+        """ Yield the encoded stream. on_progress(position) reports the
+            offset of the file sent so far; if aborted() returns true
+            AbortExport is raised.
+        """
+        for data, end in self.encoded(aborted):
+            start = time()
+            yield data
+            self.seconds['send'] += time() - start
+            self.sent_bytes += len(data)
+            if on_progress is not None:
+                on_progress(end)
+
+    def write_file(self, target, on_progress=None, aborted=None):
+        """Write the stream to the local file target."""
+        tmp_path = target + '.part'
+        try:
+            with open(tmp_path, 'wb') as f:
+                if self.compression is None:
+                    writer = SparseWriter(f)  # keep the holes
+                    for data in self.chunks(on_progress, aborted):
+                        writer.write(data)
+                    writer.finish()
+                else:
+                    for data in self.chunks(on_progress, aborted):
+                        f.write(data)
+            os.rename(tmp_path, target)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def put(self, url, on_progress=None, aborted=None):
+        """Send the stream to url in a chunked PUT request."""
+        try:
+            r = http_pool().put(url, aborted=aborted,
+                                data=self.chunks(on_progress, aborted),
+                                headers={'Content-Type': self.content_type})
+        except AbortRequest:
+            raise AbortExport()
+        r.close()
+        if r.status_code not in (200, 201, 204):
+            raise Exception("Invalid response status code: %s at %s" %
+                            (r.status_code, url))
+
+    def export(self, target, on_progress=None, aborted=None):
+        """ Stream the file to target, an http(s) URL or a local path.
+            Return the number of bytes sent.
+        """
+        logger.debug("Exporting %s to %s (%s).", self.path, target,
+                     self.compression)
+        if target.startswith(('http://', 'https://')):
+            self.put(target, on_progress, aborted)
+        else:
+            self.write_file(target, on_progress, aborted)
+        return self.sent_bytes
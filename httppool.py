@@ -0,0 +1,133 @@
+""" Shared HTTP connection pool of a worker process.
+
+    Every HTTP request of the driver goes through one requests.Session
+    per process, so connections to a mirror are kept alive between the
+    requests of a download, its range pieces and the following tasks.
+    At most HTTP_HOST_CONNECTIONS responses per host are open at a time
+    on the host: each holds one of the host's slots, lock files under
+    HTTP_SLOTS_DIR shared by every worker process like the I/O slots of
+    the datastores. Further requests wait for a slot, polling their
+    abort flag. Connect and read timeouts apply to every request.
+"""
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import requests
+
+from iolimits import lock_slot, unlock_slot
+
+logger = logging.getLogger(__name__)
+
+host_connections = int(os.getenv("HTTP_HOST_CONNECTIONS", 8))
+pool_hosts = int(os.getenv("HTTP_POOL_HOSTS", 16))
+connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", 60))
+slots_directory = os.getenv("HTTP_SLOTS_DIR", os.path.join(
+    tempfile.gettempdir(), "storagedriver-http"))
+wait_poll_interval = 0.5
+
+
+class AbortRequest(Exception):
+    pass
+
+
+class ConnectionPool(object):
+
+    """ The session of a process. Close every response returned, it
+        holds a connection slot of its host until then. A per_host of 0
+        means no limit.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, per_host=host_connections,
+                 slots_dir=slots_directory):
+        self.pid = os.getpid()
+        self.per_host = per_host
+        self.slots_dir = slots_dir
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_hosts,
+                                                pool_maxsize=per_host or 10)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def for_process(cls):
+        """Return the pool of this process, connections are not shared
+        with forked processes."""
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls()
+            return cls._instance
+
+    def acquire(self, host, aborted=None):
+        """Return the locked slot of host, waiting for a free one."""
+        if self.per_host <= 0:
+            return None
+        directory = os.path.join(self.slots_dir, hashlib.sha1(
+            host.encode('utf-8')).hexdigest()[:16])
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        waiting = threading.Event()
+        logged = False
+        while True:
+            lock = lock_slot(directory, self.per_host)
+            if lock is not None:
+                return lock
+            if aborted is not None and aborted():
+                raise AbortRequest()
+            if not logged:
+                logger.info("Waiting for a connection to %s.", host)
+                logged = True
+            waiting.wait(wait_poll_interval)
+
+    @staticmethod
+    def release(lock):
+        if lock is not None:
+            unlock_slot(lock)
+
+    def request(self, method, url, aborted=None, **kwargs):
+        """ Send a request through the pool. If aborted() returns true
+            while waiting for a connection AbortRequest is raised.
+        """
+        lock = self.acquire(urlparse(url).netloc, aborted)
+        kwargs.setdefault('timeout', (connect_timeout, read_timeout))
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except:
+            self.release(lock)
+            raise
+        close = r.close
+        released = []
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.release(lock)
+        r.close = close_and_release
+        return r
+
+    def get(self, url, aborted=None, **kwargs):
+        return self.request('GET', url, aborted, **kwargs)
+
+    def put(self, url, aborted=None, **kwargs):
+        return self.request('PUT', url, aborted, **kwargs)
+
+
+def http_pool():
+    return ConnectionPool.for_process()
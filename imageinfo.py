@@ -0,0 +1,115 @@
+""" Pure Python image header reader.
+
+    Reads the same fields `qemu-img info --output=json` reports for the
+    images the storage driver handles (qcow2 and raw, iso files are raw
+    for qemu-img as well) without starting a process. Anything it can not
+    handle exactly like qemu-img returns None, and the caller falls back
+    to qemu-img.
+"""
+import os
+import stat
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_HEADER = struct.Struct('>4sIQIIQ')
+QCOW2_INCOMPATIBLE_FEATURES = struct.Struct('>Q')
+QCOW2_INCOMPATIBLE_FEATURES_OFFSET = 72
+QCOW2_MAX_BACKING_FILE_NAME = 1023
+# dirty, compression type and extended L2 entries do not change the
+# reported fields, corrupt images and external data files do
+QCOW2_KNOWN_INCOMPATIBLE_FEATURES = (1 << 0) | (1 << 3) | (1 << 4)
+
+# Signatures of other formats qemu-img would detect instead of raw.
+FOREIGN_SIGNATURES = [
+    (0, b'QFI'),                       # qcow version 1 and 2
+    (0, b'QED\x00'),                   # qed
+    (0, b'KDMV'),                      # vmdk sparse extent
+    (0, b'COWD'),                      # vmdk 3
+    (0, b'# Disk DescriptorFile'),     # vmdk descriptor
+    (0, b'conectix'),                  # vpc
+    (0, b'vhdxfile'),                  # vhdx
+    (0, b'LUKS\xba\xbe'),              # luks
+    (0, b'Bochs Virtual HD Image'),    # bochs
+    (0, b'WithoutFreeSpace'),          # parallels
+    (0, b'WithouFreSpacExt'),          # parallels
+    (0, b'#!/bin/sh\n#V2.0 Format\n'),  # cloop
+    (0x40, b'\x7f\x10\xda\xbe'),       # vdi
+]
+PROBE_SIZE = 512
+
+
+def allocated_size(st):
+    """Allocated size of a file the way qemu-img reports it."""
+    return st.st_blocks * 512
+
+
+def read_qcow2_info(f, st):
+    header = f.read(QCOW2_INCOMPATIBLE_FEATURES_OFFSET +
+                    QCOW2_INCOMPATIBLE_FEATURES.size)
+    if len(header) < QCOW2_HEADER.size:
+        return None
+    (magic, version, backing_file_offset, backing_file_size,
+     cluster_bits, size) = QCOW2_HEADER.unpack_from(header)
+    if magic != QCOW2_MAGIC or version not in (2, 3):
+        return None
+    if version == 3:
+        if len(header) < (QCOW2_INCOMPATIBLE_FEATURES_OFFSET +
+                          QCOW2_INCOMPATIBLE_FEATURES.size):
+            return None
+        incompatible_features = QCOW2_INCOMPATIBLE_FEATURES.unpack_from(
+            header, QCOW2_INCOMPATIBLE_FEATURES_OFFSET)[0]
+        if incompatible_features & ~QCOW2_KNOWN_INCOMPATIBLE_FEATURES:
+            return None
+    info = {
+        'format': 'qcow2',
+        'virtual-size': size,
+        'actual-size': allocated_size(st),
+    }
+    if backing_file_offset:
+        if backing_file_size > QCOW2_MAX_BACKING_FILE_NAME:
+            return None
+        f.seek(backing_file_offset)
+        backing_file = f.read(backing_file_size)
+        if len(backing_file) != backing_file_size:
+            return None
+        try:
+            info['backing-filename'] = backing_file.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    return info
+
+
+def read_raw_info(f, st, path):
+    head = f.read(PROBE_SIZE)
+    for offset, signature in FOREIGN_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return None
+    if path.lower().endswith('.dmg'):
+        return None  # qemu-img probes dmg by extension and trailer
+    return {
+        'format': 'raw',
+        'virtual-size': st.st_size,
+        'actual-size': allocated_size(st),
+    }
+
+
+def read_image_info(path):
+    """ Return the format, virtual-size, actual-size and backing-filename
+        of the image at path, or None if qemu-img has to be asked.
+    """
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            if f.read(len(QCOW2_MAGIC)) == QCOW2_MAGIC:
+                f.seek(0)
+                return read_qcow2_info(f, st)
+            f.seek(0)
+            return read_raw_info(f, st, path)
+    except (IOError, OSError, struct.error):
+        logger.debug("Cannot read image header of %s", path, exc_info=True)
+        return None
@@ -0,0 +1,98 @@
+""" Minimal inotify binding through ctypes.
+
+    Only what the inventory watcher needs: one descriptor, adding and
+    removing watches, and reading the queued events.
+"""
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+def available():
+    try:
+        return hasattr(libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+
+def check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+
+class Inotify(object):
+
+    """ An inotify descriptor. """
+
+    def __init__(self):
+        self.fd = check(libc().inotify_init1(IN_CLOEXEC | IN_NONBLOCK))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        if hasattr(os, 'fsencode'):
+            path = os.fsencode(path)
+        return check(libc().inotify_add_watch(self.fd, path, mask))
+
+    def rm_watch(self, wd):
+        try:
+            check(libc().inotify_rm_watch(self.fd, wd))
+        except OSError as e:
+            if e.errno != errno.EINVAL:  # already removed
+                raise
+
+    def read(self, size=65536):
+        """Return the queued (wd, mask, cookie, name) events."""
+        try:
+            data = os.read(self.fd, size)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            if hasattr(os, 'fsdecode'):
+                name = os.fsdecode(name)
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
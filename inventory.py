@@ -0,0 +1,415 @@
+""" Single pass datastore inventory.
+
+    The datastore directory and its trash are read once, and the images
+    that are not in the metadata cache are probed on a bounded thread
+    pool, so the per file round trips of NFS backed datastores overlap.
+
+    With INVENTORY_WATCH set, each worker process keeps a live inventory
+    of the datastores it has listed, kept current by inotify: events
+    only mark the changed names, which are stat'ed and probed when the
+    inventory is read next. The datastore is rescanned in full at start,
+    after the event queue overflowed and every INVENTORY_RESCAN_INTERVAL
+    seconds.
+
+    With INVENTORY_PREWARM set, the worker refreshes the metadata caches
+    of the configured datastores in the background when it starts, so
+    the first listing after a restart has nothing left to probe.
+"""
+import os
+import select
+import logging
+import threading
+from stat import S_ISDIR
+from time import time
+from multiprocessing.pool import ThreadPool
+
+import inotify
+from config import datastores, getenv_bool
+from disk import Disk, DiskMetadataCache
+
+logger = logging.getLogger(__name__)
+
+trash_directory = "trash"
+inventory_workers = int(os.getenv("INVENTORY_WORKERS", 8))
+watch_inventory = getenv_bool("INVENTORY_WATCH", "false")
+rescan_interval = float(os.getenv("INVENTORY_RESCAN_INTERVAL", 600))
+prewarm_inventory = getenv_bool("INVENTORY_PREWARM", "false")
+
+# no IN_MODIFY: running VMs write their images all the time, those are
+# refreshed when closed, on attribute changes and by the periodic rescan
+WATCH_MASK = (inotify.IN_ATTRIB | inotify.IN_CLOSE_WRITE |
+              inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO | inotify.IN_CREATE |
+              inotify.IN_DELETE | inotify.IN_DELETE_SELF |
+              inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR)
+
+
+def scan_dir(dir):
+    """ Return (name, is_dir, stat) for each entry of dir.
+        Stat follows symlinks like os.path.isdir and getsize do.
+    """
+    scandir = getattr(os, 'scandir', None)
+    entries = []
+    if scandir is not None:
+        for entry in scandir(dir):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue  # removed or dangling symlink
+            entries.append((entry.name, entry.is_dir(), st))
+    else:
+        for name in os.listdir(dir):
+            try:
+                st = os.stat(os.path.join(dir, name))
+            except OSError:
+                continue
+            entries.append((name, S_ISDIR(st.st_mode), st))
+    return entries
+
+
+def probe_all(dir, entries, workers=None, prune=True):
+    """ Return Disk objects for (name, stat) entries, probing in parallel.
+        Unless prune is false, the entries are all files of dir and
+        the cache entries of other files are dropped.
+    """
+    cache = DiskMetadataCache.for_dir(dir)
+    disks = [None] * len(entries)
+    missing = []
+    for i, (name, st) in enumerate(entries):
+        desc = cache.lookup(name, st)
+        if desc is not None:
+            disks[i] = Disk(dir, name, **desc)
+        else:
+            missing.append(i)
+
+    def probe(i):
+        name, st = entries[i]
+        disk = Disk.probe(dir, name)
+        cache.store(name, st, disk.get_desc())
+        return disk
+
+    if len(missing) > 1 and (workers or inventory_workers) > 1:
+        pool = ThreadPool(min(workers or inventory_workers, len(missing)))
+        try:
+            probed = pool.map(probe, missing)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        probed = [probe(i) for i in missing]
+    for i, disk in zip(missing, probed):
+        disks[i] = disk
+    if prune:
+        cache.prune([name for name, st in entries])
+    cache.save()
+    return disks
+
+
+def scan(datastore, workers=None):
+    """ Return disks, dumps and trash entries of datastore.
+        Disks are Disk objects, dumps and trash are name-size dicts.
+    """
+    live = live_inventory(datastore)
+    if live is not None:
+        return live.inventory(workers)
+    return scan_datastore(datastore, workers)
+
+
+def list_files(datastore):
+    """Return the names of the files of datastore."""
+    live = live_inventory(datastore)
+    if live is not None:
+        return live.file_names()
+    return [name for name, is_dir, st in scan_dir(datastore) if not is_dir]
+
+
+def scan_datastore(datastore, workers=None):
+    images = []
+    dumps = []
+    for name, is_dir, st in scan_dir(datastore):
+        if is_dir:
+            continue
+        if name.endswith(".dump"):
+            dumps.append({'name': name, 'size': st.st_size})
+        else:
+            images.append((name, st))
+    trash_path = os.path.join(datastore, trash_directory)
+    if os.path.isdir(trash_path):
+        trash = [{'name': name, 'size': st.st_size}
+                 for name, is_dir, st in scan_dir(trash_path)]
+    else:
+        trash = []
+    return {
+        'disks': probe_all(datastore, images, workers),
+        'dumps': dumps,
+        'trash': trash,
+    }
+
+
+class LiveInventory(object):
+
+    """ In-memory inventory of one datastore, updated from the names
+        the watcher marks as changed.
+    """
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.trash_path = os.path.join(datastore, trash_directory)
+        self.files = {}
+        self.trash = {}
+        self.disks = {}  # name: (stat key, Disk)
+        self.changed = set()
+        self.trash_changed = set()
+        self.rescan_needed = True
+        self.result = None
+        self.events_lock = threading.Lock()
+        self.lock = threading.Lock()
+
+    def mark(self, name, trash=False):
+        with self.events_lock:
+            (self.trash_changed if trash else self.changed).add(name)
+
+    def mark_rescan(self):
+        with self.events_lock:
+            self.rescan_needed = True
+
+    def rescan(self):
+        logger.debug("Rescanning datastore %s.", self.datastore)
+        self.files = dict((name, st) for name, is_dir, st
+                          in scan_dir(self.datastore) if not is_dir)
+        if os.path.isdir(self.trash_path):
+            self.trash = dict((name, st) for name, is_dir, st
+                              in scan_dir(self.trash_path))
+        else:
+            self.trash = {}
+        for name, (key, disk) in list(self.disks.items()):
+            st = self.files.get(name)
+            if st is None or DiskMetadataCache.stat_key(st) != key:
+                del self.disks[name]
+        cache = DiskMetadataCache.for_dir(self.datastore)
+        cache.prune(self.files)
+        cache.save()
+
+    @staticmethod
+    def update(entries, dir, name, files_only):
+        try:
+            st = os.stat(os.path.join(dir, name))
+        except OSError:
+            st = None
+        if st is None or (files_only and S_ISDIR(st.st_mode)):
+            entries.pop(name, None)
+        else:
+            entries[name] = st
+
+    def apply(self):
+        """Bring the inventory up to date, return whether it changed."""
+        with self.events_lock:
+            rescan_needed, self.rescan_needed = self.rescan_needed, False
+            changed, self.changed = self.changed, set()
+            trash_changed, self.trash_changed = self.trash_changed, set()
+        if rescan_needed:
+            try:
+                self.rescan()
+            except:
+                self.mark_rescan()
+                raise
+            return True
+        for name in changed:
+            self.update(self.files, self.datastore, name, True)
+            entry = self.disks.get(name)
+            st = self.files.get(name)
+            if entry is not None and (
+                    st is None or DiskMetadataCache.stat_key(st) != entry[0]):
+                del self.disks[name]
+        for name in trash_changed:
+            self.update(self.trash, self.trash_path, name, False)
+        return bool(changed or trash_changed)
+
+    def inventory(self, workers=None):
+        """Return the inventory in the format of scan_datastore."""
+        with self.lock:
+            if self.apply() or self.result is None:
+                missing = [(name, st) for name, st in self.files.items()
+                           if not name.endswith(".dump") and
+                           name not in self.disks]
+                if missing:
+                    probed = probe_all(self.datastore, missing, workers,
+                                       prune=False)
+                    for (name, st), disk in zip(missing, probed):
+                        self.disks[name] = (DiskMetadataCache.stat_key(st),
+                                            disk)
+                self.result = {
+                    'disks': [self.disks[name][1]
+                              for name in sorted(self.disks)],
+                    'dumps': [{'name': name, 'size': st.st_size}
+                              for name, st in sorted(self.files.items())
+                              if name.endswith(".dump")],
+                    'trash': [{'name': name, 'size': st.st_size}
+                              for name, st in sorted(self.trash.items())],
+                }
+            return dict((k, list(v)) for k, v in self.result.items())
+
+    def file_names(self):
+        with self.lock:
+            if self.apply():
+                self.result = None
+            return sorted(self.files)
+
+
+class InventoryWatcher(object):
+
+    """ The inotify descriptor and thread of a worker process, watching
+        every datastore with a live inventory and its trash.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.inotify = inotify.Inotify()
+        self.watches = {}  # wd: (inventory, is trash)
+        self.inventories = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run,
+                                       name='inventory-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        """Return the watcher of this process, starting it if needed."""
+        with cls._instance_lock:
+            watcher = cls._instance
+            if (watcher is None or watcher.pid != os.getpid() or
+                    not watcher.thread.is_alive()):
+                if watcher is not None and watcher.pid == os.getpid():
+                    watcher.inotify.close()
+                watcher = cls._instance = cls()
+            return watcher
+
+    def watch(self, datastore):
+        """Return the live inventory of datastore, watching it."""
+        with self.lock:
+            live = self.inventories.get(datastore)
+            if live is None:
+                live = LiveInventory(datastore)
+                wd = self.inotify.add_watch(datastore, WATCH_MASK)
+                self.watches[wd] = (live, False)
+                self.inventories[datastore] = live
+                self.watch_trash(live)
+            return live
+
+    def watch_trash(self, live):
+        try:
+            wd = self.inotify.add_watch(live.trash_path, WATCH_MASK)
+        except OSError:
+            return  # created later
+        self.watches[wd] = (live, True)
+
+    def dispatch(self, wd, mask, name):
+        if mask & inotify.IN_Q_OVERFLOW:
+            logger.warning("Inotify queue overflowed, rescanning.")
+            for live in self.inventories.values():
+                live.mark_rescan()
+            return
+        if wd not in self.watches:
+            return
+        live, is_trash = self.watches[wd]
+        if mask & inotify.IN_IGNORED:
+            del self.watches[wd]
+            if is_trash:
+                live.mark_rescan()
+            elif self.inventories.get(live.datastore) is live:
+                # watched again when it is listed next
+                del self.inventories[live.datastore]
+                for trash_wd, (other, other_is_trash) in list(
+                        self.watches.items()):
+                    if other is live:
+                        self.inotify.rm_watch(trash_wd)
+        elif mask & inotify.IN_MOVE_SELF:
+            self.inotify.rm_watch(wd)
+        elif mask & inotify.IN_DELETE_SELF:
+            pass  # followed by IN_IGNORED
+        elif is_trash:
+            live.mark(name, trash=True)
+        else:
+            if (name == trash_directory and mask & inotify.IN_ISDIR and
+                    mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO)):
+                self.watch_trash(live)
+                live.mark_rescan()
+            live.mark(name)
+
+    def run(self):
+        last_rescan = time()
+        while True:
+            try:
+                readable = select.select([self.inotify], [], [],
+                                         rescan_interval or None)[0]
+                if readable:
+                    events = self.inotify.read()
+                    with self.lock:
+                        for wd, mask, cookie, name in events:
+                            self.dispatch(wd, mask, name)
+                if rescan_interval and time() - last_rescan >= \
+                        rescan_interval:
+                    last_rescan = time()
+                    with self.lock:
+                        for live in self.inventories.values():
+                            live.mark_rescan()
+            except Exception:
+                logger.exception("Inventory watcher failed, rescanning.")
+                with self.lock:
+                    for live in self.inventories.values():
+                        live.mark_rescan()
+                threading.Event().wait(1)
+
+
+def live_inventory(datastore):
+    """Return the live inventory of datastore, or None if the datastore
+    is not watched."""
+    if not watch_inventory or not inotify.available():
+        return None
+    try:
+        return InventoryWatcher.get().watch(os.path.realpath(datastore))
+    except OSError:
+        logger.warning("Cannot watch %s, scanning it.", datastore,
+                       exc_info=True)
+        return None
+
+
+def watch_datastores():
+    """Start watching the configured datastores and build their
+    inventories in the background."""
+    def build():
+        for datastore in datastores():
+            try:
+                live = live_inventory(datastore)
+                if live is not None:
+                    live.inventory()
+            except Exception:
+                logger.exception("Cannot build inventory of %s.", datastore)
+
+    if watch_inventory:
+        thread = threading.Thread(target=build, name='inventory-build')
+        thread.daemon = True
+        thread.start()
+
+
+def prewarm_datastores():
+    """Refresh the metadata caches of the configured datastores in the
+    background. Called in the main process of the worker."""
+    def prewarm():
+        for datastore in datastores():
+            try:
+                started = time()
+                scan_datastore(datastore)
+                logger.info("Prewarmed inventory of %s in %.1f s.",
+                            datastore, time() - started)
+            except Exception:
+                logger.exception("Cannot prewarm inventory of %s.",
+                                 datastore)
+
+    if prewarm_inventory and datastores():
+        thread = threading.Thread(target=prewarm, name='inventory-prewarm')
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,186 @@
+""" Versioned inventory of a datastore.
+
+    Each inventory of a datastore is compared to the previous one, and
+    if anything changed it is recorded under the next generation with
+    the names which changed. A client passing back the token of a
+    generation it has seen gets only the disks, dumps and trash entries
+    added, changed or removed since; without a token, or with one older
+    than the last INVENTORY_HISTORY changes, it gets every entry with
+    reset set. Results are split in pages of INVENTORY_PAGE_SIZE
+    entries, and disks are rows of DISK_FIELDS instead of descriptors.
+"""
+import os
+import json
+import uuid
+import fcntl
+import logging
+
+from config import state_directory
+
+logger = logging.getLogger(__name__)
+
+inventory_history = int(os.getenv("INVENTORY_HISTORY", 10000))
+inventory_page_size = int(os.getenv("INVENTORY_PAGE_SIZE", 1000))
+
+KINDS = ('disks', 'dumps', 'trash')
+DISK_FIELDS = ('name', 'format', 'type', 'size', 'actual_size', 'base_name')
+
+
+def compact(inventory):
+    """Return the entries of a scan by kind and name: a row of
+    DISK_FIELDS for disks, the size for dumps and trash."""
+    disks = {}
+    for disk in inventory['disks']:
+        desc = disk.get_desc()
+        disks[disk.name] = [desc[field] for field in DISK_FIELDS]
+    return {
+        'disks': disks,
+        'dumps': dict((d['name'], d['size']) for d in inventory['dumps']),
+        'trash': dict((t['name'], t['size']) for t in inventory['trash']),
+    }
+
+
+def parse_token(token):
+    """Return the epoch and generation of token, (None, None) if it is
+    not valid."""
+    try:
+        epoch, generation = token.rsplit('.', 1)
+        return epoch, int(generation)
+    except (AttributeError, ValueError):
+        return None, None
+
+
+def sort_key(key):
+    kind, name = key
+    return KINDS.index(kind), name
+
+
+class InventoryLog(object):
+
+    """ The generations of the inventory of one datastore. The state is
+        the entries of the last generation and the log of changes, a
+        list of [generation, kind, name]; tokens of generations before
+        base can not be served from the log. The epoch changes when the
+        state is lost, invalidating every token.
+    """
+
+    def __init__(self, dir):
+        self.dir = os.path.realpath(dir)
+        self.path = os.path.join(self.dir, state_directory, 'inventory.json')
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, state):
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.rename(tmp_path, self.path)
+
+    def record(self, entries):
+        """Record entries as the next generation if they changed, return
+        the state."""
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = self.load()
+                if state is None:
+                    state = {'epoch': uuid.uuid4().hex[:12], 'generation': 1,
+                             'base': 1, 'entries': entries, 'log': []}
+                    self.save(state)
+                    return state
+                changed = False
+                for kind in KINDS:
+                    old = state['entries'].get(kind, {})
+                    new = entries[kind]
+                    for name in set(old) | set(new):
+                        if old.get(name) != new.get(name):
+                            changed = True
+                            state['log'].append(
+                                [state['generation'] + 1, kind, name])
+                if changed:
+                    state['generation'] += 1
+                    state['entries'] = entries
+                    if len(state['log']) > inventory_history:
+                        state['base'] = state['log'][-inventory_history -
+                                                     1][0]
+                        state['log'] = state['log'][-inventory_history:]
+                    self.save(state)
+                return state
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def changes(self, inventory, token=None, cursor=None, limit=None):
+        """ Return the entries of inventory changed since the generation
+            of token:
+
+                {'token': token of this generation, None before the
+                          last page,
+                 'reset': whether the client has to drop its entries,
+                 'cursor': None, or the cursor of the next page,
+                 'disks': {'fields': DISK_FIELDS, 'changed': [row, ...],
+                           'removed': [name, ...]},
+                 'dumps': {'changed': [[name, size], ...],
+                           'removed': [name, ...]},
+                 'trash': like dumps}
+
+            Pass the cursor back with the same token for the next page;
+            a cursor of another token or of a lost state is refused.
+        """
+        state = self.record(compact(inventory))
+        entries = state['entries']
+        epoch, since = parse_token(token)
+        full = not (epoch == state['epoch'] and
+                    state['base'] <= since <= state['generation'])
+        target = state['generation']
+        after = None
+        if cursor is not None:
+            if (len(cursor) != 6 or cursor[0] != state['epoch'] or
+                    cursor[1] > target or cursor[2] != full):
+                raise Exception("Invalid inventory cursor, list again "
+                                "without it.")
+            if cursor[3] != token:
+                raise Exception("Inventory cursor of token %s passed with "
+                                "token %s." % (cursor[3], token))
+            target = cursor[1]
+            after = sort_key(cursor[4:6])
+        if full:
+            keys = [(kind, name) for kind in KINDS for name in entries[kind]]
+        else:
+            keys = set((kind, name) for generation, kind, name
+                       in state['log'] if generation > since)
+        keys = sorted(keys, key=sort_key)
+        if after is not None:
+            keys = [key for key in keys if sort_key(key) > after]
+        limit = limit or inventory_page_size
+        page = keys[:limit]
+
+        result = {
+            'token': '%s.%d' % (state['epoch'], target),
+            'reset': full and after is None,
+            'cursor': None,
+            'disks': {'fields': list(DISK_FIELDS), 'changed': [],
+                      'removed': []},
+            'dumps': {'changed': [], 'removed': []},
+            'trash': {'changed': [], 'removed': []},
+        }
+        if len(keys) > limit:
+            result['token'] = None
+            result['cursor'] = [state['epoch'], target, full,
+                                token] + list(page[-1])
+        for kind, name in page:
+            value = entries[kind].get(name)
+            if value is None:
+                result[kind]['removed'].append(name)
+            elif kind == 'disks':
+                result[kind]['changed'].append(value)
+            else:
+                result[kind]['changed'].append([name, value])
+        return result
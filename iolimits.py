@@ -0,0 +1,267 @@
+""" Per-datastore limits of bulk I/O.
+
+    Bulk operations (downloads, merges) take one of a fixed number of
+    slots of their datastore before they start, so a burst of imports
+    can not saturate a datastore and starve the short operations. Slots
+    are lock files in the datastore's state directory, shared by every
+    worker process of the host.
+
+    The bytes moved by the copy loops of each operation type are
+    limited by a token bucket per datastore, shared by the worker
+    processes of the host through a small state file. qemu-img
+    processes run under ionice, and can be given the merge rate with
+    `convert -r` if the installed qemu-img supports it.
+
+    The limits are the per-datastore IO_LIMITS setting, e.g.
+
+        IO_LIMITS='{"default": {"concurrency": 2,
+                                "download_rate": 104857600},
+                    "/datastore": {"merge_rate": 52428800,
+                                   "ionice": "idle"}}'
+
+    concurrency       number of slots, 0 for no limit
+    download_rate     bytes per second of downloads, 0 for no limit
+    merge_rate        bytes per second of merges, 0 for no limit
+    ionice            I/O class of qemu-img, "idle" or "best-effort:N"
+    qemu_rate_limit   pass merge_rate to qemu-img convert -r
+
+    The rates can be changed at runtime with the set_io_rate task; a
+    process reads them at most every IO_RATE_CHECK_INTERVAL seconds, and
+    does not touch the bucket while the rate is 0.
+"""
+import os
+import errno
+import fcntl
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+from time import time, sleep
+
+from config import datastore_options, state_directory
+
+logger = logging.getLogger(__name__)
+
+io_limits_defaults = {'concurrency': 2,
+                      'download_rate': 0,
+                      'merge_rate': 0,
+                      'ionice': None,
+                      'qemu_rate_limit': False}
+slot_poll_interval = float(os.getenv("IO_SLOT_POLL_INTERVAL", 1.0))
+# how long a process uses the rate before reading the state file again
+rate_check_interval = float(os.getenv("IO_RATE_CHECK_INTERVAL", 1.0))
+slot_directory = "slots"
+# bucket state is kept on a local filesystem, it is changed per chunk
+limits_directory = os.getenv("IO_LIMITS_DIR", os.path.join(
+    tempfile.gettempdir(), "storagedriver-limits"))
+OPERATIONS = ('download', 'merge')
+IONICE_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+
+def io_limits(datastore):
+    return datastore_options('IO_LIMITS', datastore, io_limits_defaults)
+
+
+class SlotAborted(Exception):
+    pass
+
+
+def lock_slot(directory, count):
+    """Return the locked file of a free one of count slots in
+    directory, None if all are taken."""
+    for i in range(count):
+        lock = open(os.path.join(directory, '%d.lock' % i), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            lock.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            continue
+        return lock
+    return None
+
+
+def unlock_slot(lock):
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+
+
+class IOSlot(object):
+
+    """ Hold one of the bulk I/O slots of datastore while active.
+        While all slots are taken it waits, raising SlotAborted if
+        aborted() returns true. A concurrency of 0 means no limit.
+    """
+
+    def __init__(self, datastore, aborted=None, concurrency=None):
+        self.datastore = os.path.realpath(datastore)
+        self.aborted = aborted
+        if concurrency is None:
+            concurrency = int(io_limits(self.datastore)['concurrency'])
+        self.concurrency = concurrency
+        self.path = os.path.join(self.datastore, state_directory,
+                                 slot_directory)
+        self.lock = None
+
+    def try_acquire(self):
+        self.lock = lock_slot(self.path, self.concurrency)
+        return self.lock is not None
+
+    def __enter__(self):
+        if self.concurrency <= 0:
+            return self
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+        except OSError:
+            logger.warning("Cannot create %s, not limiting I/O.",
+                           self.path, exc_info=True)
+            return self
+        waiting = threading.Event()
+        logged = False
+        while not self.try_acquire():
+            if self.aborted is not None and self.aborted():
+                raise SlotAborted()
+            if not logged:
+                logger.info("Waiting for an I/O slot of %s.", self.datastore)
+                logged = True
+            waiting.wait(slot_poll_interval)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.lock is not None:
+            unlock_slot(self.lock)
+            self.lock = None
+
+
+class RateLimiter(object):
+
+    """ Token bucket of an operation type on a datastore. The state
+        file holds the tokens, the time of the last refill and the rate
+        set at runtime (negative to use the configured rate). Tokens
+        may go negative; a caller sleeps until its bytes are paid for.
+    """
+
+    STATE = struct.Struct('ddd')
+
+    def __init__(self, datastore, operation):
+        if operation not in OPERATIONS:
+            raise Exception('Invalid operation: %s' % operation)
+        self.datastore = os.path.realpath(datastore)
+        self.operation = operation
+        self.configured = float(
+            io_limits(self.datastore)['%s_rate' % operation] or 0)
+        key = hashlib.sha1(self.datastore.encode('utf-8')).hexdigest()
+        self.path = os.path.join(limits_directory,
+                                 '%s-%s' % (key[:16], operation))
+        self.cached_rate = None
+        self.checked = 0
+
+    def update(self, change):
+        """Apply change(state) to the state under the file lock, return
+        what it returns."""
+        if not os.path.isdir(limits_directory):
+            try:
+                os.makedirs(limits_directory)
+            except OSError:
+                if not os.path.isdir(limits_directory):
+                    raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, self.STATE.size)
+            if len(data) == self.STATE.size:
+                state = list(self.STATE.unpack(data))
+            else:
+                state = [0.0, time(), -1.0]
+            result = change(state)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, self.STATE.pack(*state))
+            return result
+        finally:
+            os.close(fd)
+
+    def effective_rate(self, state):
+        return state[2] if state[2] >= 0 else self.configured
+
+    def rate(self):
+        return self.update(self.effective_rate)
+
+    def current_rate(self):
+        """The rate, read from the state at most every
+        rate_check_interval seconds."""
+        now = time()
+        if self.cached_rate is None or now - self.checked >= \
+                rate_check_interval:
+            self.cached_rate = self.rate()
+            self.checked = now
+        return self.cached_rate
+
+    def set_rate(self, rate):
+        """Set the rate of every process, None to use the configured."""
+        def change(state):
+            state[2] = -1.0 if rate is None else float(rate)
+            state[0] = 0.0
+            state[1] = time()
+        self.update(change)
+
+    def consume(self, size):
+        """Take size bytes from the bucket, sleeping if they are not
+        available. Return whether the rate is limited."""
+        if self.current_rate() <= 0:
+            return False
+
+        def change(state):
+            rate = self.effective_rate(state)
+            now = time()
+            if rate <= 0:
+                state[0], state[1] = 0.0, now
+                return 0
+            # at most one second worth of burst
+            state[0] = min(rate, state[0] + (now - state[1]) * rate) - size
+            state[1] = now
+            return -state[0] / rate if state[0] < 0 else 0
+
+        wait = self.update(change)
+        if wait > 0:
+            sleep(wait)
+        return True
+
+
+def rate_limiter(datastore, operation):
+    """Return the limiter of operation on datastore, None if the limits
+    can not be shared."""
+    limiter = RateLimiter(datastore, operation)
+    try:
+        limiter.current_rate()
+    except (IOError, OSError):
+        logger.warning("Cannot use %s, not limiting %s rate.",
+                       limiter.path, operation, exc_info=True)
+        return None
+    return limiter
+
+
+def ionice_cmdline(ionice):
+    """Return the command prefix running a process in I/O class ionice,
+    e.g. "idle" or "best-effort:7"."""
+    if not ionice:
+        return []
+    name, _, level = ionice.partition(':')
+    cmdline = ['ionice', '-c', IONICE_CLASSES[name]]
+    if level:
+        cmdline.extend(['-n', level])
+    return cmdline
+
+
+def convert_limits(datastore):
+    """Return the qemu-img convert options limiting merges to
+    datastore."""
+    limits = io_limits(datastore)
+    options = {'ionice': limits['ionice']}
+    if limits['qemu_rate_limit']:
+        rate = RateLimiter(datastore, 'merge').rate()
+        if rate > 0:
+            options['rate_limit'] = int(rate)
+    return options
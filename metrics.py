@@ -0,0 +1,414 @@
+""" Worker metrics in the Prometheus text exposition format.
+
+    Disk operations record counters and histograms in the process that
+    runs them. If metrics are configured, pool processes spool a
+    snapshot of their metrics to a per-worker directory after every
+    task, and the main process of the worker serves the merged snapshots
+    over HTTP on METRICS_PORT, or writes them to METRICS_TEXTFILE_DIR for
+    the textfile collector of node_exporter. Tasks reading the totals of
+    the worker spool their process on demand. Snapshots of exited
+    processes are dropped when collected. The first worker of a host
+    binding the port serves the metrics of the others too; every series
+    has a worker label.
+"""
+import os
+import json
+import errno
+import logging
+import tempfile
+import threading
+from time import time
+from contextlib import contextmanager
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+metrics_port = int(os.getenv("METRICS_PORT", 0))
+metrics_address = os.getenv("METRICS_ADDRESS", "127.0.0.1")
+metrics_textfile_dir = os.getenv("METRICS_TEXTFILE_DIR", "")
+metrics_interval = float(os.getenv("METRICS_INTERVAL", 15))
+spool_root = os.getenv("METRICS_SPOOL_DIR", os.path.join(
+    tempfile.gettempdir(), "storagedriver-metrics"))
+enabled = bool(metrics_port or metrics_textfile_dir)
+
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600,
+           7200)
+
+METRICS = {
+    'storagedriver_operations_total':
+        ('counter', "Disk operations by outcome."),
+    'storagedriver_operation_seconds':
+        ('histogram', "Wall time of disk operations."),
+    'storagedriver_phase_seconds':
+        ('histogram', "Time disk operations spent in each phase. "
+                      "Phases run on other threads may overlap."),
+    'storagedriver_bytes_total':
+        ('counter', "Bytes moved by disk operations."),
+    'storagedriver_subprocess_seconds':
+        ('histogram', "Wall time of subprocesses."),
+    'storagedriver_qemu_img_invocations_total':
+        ('counter', "qemu-img runs by subcommand."),
+    'storagedriver_metadata_cache_requests_total':
+        ('counter', "Disk metadata lookups served from (hit) or missing "
+                    "(miss) the metadata cache."),
+    'storagedriver_overlay_pool_requests_total':
+        ('counter', "Snapshots served from (hit) or missing (miss) the "
+                    "overlay pool."),
+    'storagedriver_progress_updates_total':
+        ('counter', "Progress updates sent to the broker."),
+    'storagedriver_broker_calls_total':
+        ('counter', "Broker round trips of progress reporting."),
+    'storagedriver_tasks_total':
+        ('counter', "Celery tasks by final state."),
+    'storagedriver_task_seconds':
+        ('histogram', "Run time of Celery tasks."),
+}
+
+
+def escape(value):
+    return (u'%s' % value).replace('\\', r'\\').replace(
+        '\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+
+class Registry(object):
+
+    """ Counters and histograms keyed by metric name and labels. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.token = None
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            # names the spool file of this process
+            self.token = '%d-%d' % (os.getpid(), time() * 1000)
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            # cumulative bucket counts, then the sum and the count
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def total(self, name, **labels):
+        """Return the sum of the series of counter name having labels."""
+        labels = set(labels.items())
+        with self.lock:
+            return sum(value for (n, l), value in self.counters.items()
+                       if n == name and labels <= set(l))
+
+    def dump(self):
+        with self.lock:
+            return {
+                'counters': [[n, dict(l), v]
+                             for (n, l), v in self.counters.items()],
+                'histograms': [[n, dict(l), list(h)]
+                               for (n, l), h in self.histograms.items()],
+            }
+
+    def load(self, data, **extra_labels):
+        """Add a dump to the registry, with extra labels."""
+        for name, labels, value in data.get('counters', ()):
+            labels.update(extra_labels)
+            self.inc(name, value, **labels)
+        for name, labels, values in data.get('histograms', ()):
+            labels.update(extra_labels)
+            key = self.key(name, labels)
+            with self.lock:
+                h = self.histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    h[i] += value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(METRICS):
+                kind, help = METRICS[name]
+                samples = self.counters if kind == 'counter' \
+                    else self.histograms
+                keys = sorted(k for k in samples if k[0] == name)
+                if not keys:
+                    continue
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key in keys:
+                    labels = key[1]
+                    if kind == 'counter':
+                        lines.append('%s%s %s' % (
+                            name, format_labels(labels), samples[key]))
+                        continue
+                    h = samples[key]
+                    for bound, count in zip(BUCKETS + ('+Inf', ), h[:-2] +
+                                            h[-1:]):
+                        lines.append('%s_bucket%s %s' % (
+                            name, format_labels(labels + (('le', bound), )),
+                            count))
+                    lines.append('%s_sum%s %s' % (
+                        name, format_labels(labels), h[-2]))
+                    lines.append('%s_count%s %s' % (
+                        name, format_labels(labels), h[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the wall time of the block in histogram name."""
+    start = time()
+    try:
+        yield
+    finally:
+        observe(name, time() - start, **labels)
+
+
+@contextmanager
+def subprocess_timer(cmdline):
+    """Time a subprocess and count qemu-img invocations."""
+    command = os.path.basename(cmdline[0])
+    if command == 'qemu-img':
+        inc('storagedriver_qemu_img_invocations_total',
+            subcommand=cmdline[1])
+    with timer('storagedriver_subprocess_seconds', command=command):
+        yield
+
+
+class Operation(object):
+
+    """ Record one disk operation, e.g.
+
+            with Operation('download') as op:
+                for chunk in op.timed('network', chunks):
+                    with op.phase('write'):
+                        ...
+                op.moved(size, 'written')
+
+        Phase times are summed and observed once, when the operation
+        ends. Set outcome to record something other than success or
+        failure.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.outcome = 'success'
+        self.seconds = {}
+        self.bytes = {}
+        self.start = None
+
+    def add_time(self, phase, seconds):
+        self.seconds[phase] = self.seconds.get(phase, 0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        start = time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time() - start)
+
+    def timed(self, phase, iterable):
+        """Yield from iterable, adding the time spent waiting for the
+        items to phase."""
+        iterator = iter(iterable)
+        while True:
+            start = time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time() - start)
+                return
+            self.add_time(phase, time() - start)
+            yield item
+
+    def moved(self, size, kind):
+        self.bytes[kind] = self.bytes.get(kind, 0) + size
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        outcome = self.outcome if exc_type is None else 'failure'
+        inc('storagedriver_operations_total', operation=self.name,
+            outcome=outcome)
+        observe('storagedriver_operation_seconds', time() - self.start,
+                operation=self.name, outcome=outcome)
+        for phase, seconds in self.seconds.items():
+            observe('storagedriver_phase_seconds', seconds,
+                    operation=self.name, phase=phase)
+        for kind, size in self.bytes.items():
+            inc('storagedriver_bytes_total', size, operation=self.name,
+                kind=kind)
+
+
+_task_starts = {}
+
+
+def task_started(task_id):
+    _task_starts[task_id] = time()
+
+
+def task_finished(task_id, task_name, state):
+    start = _task_starts.pop(task_id, None)
+    inc('storagedriver_tasks_total', task=task_name, state=state)
+    if start is not None:
+        observe('storagedriver_task_seconds', time() - start,
+                task=task_name)
+
+
+def write_atomic(path, data):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def flush(worker, force=False):
+    """Spool the metrics of this process for the worker's exporter, if
+    metrics are enabled or force is set."""
+    if not (enabled or force):
+        return
+    directory = os.path.join(spool_root, worker)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_atomic(os.path.join(directory, registry.token + '.json'),
+                     json.dumps(registry.dump()))
+    except (IOError, OSError):
+        logger.warning("Cannot spool metrics to %s.", directory,
+                       exc_info=True)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def collect(workers=None):
+    """Return a registry merging the spooled metrics of workers, by
+    default of every worker of the host."""
+    merged = Registry()
+    if workers is None:
+        try:
+            workers = os.listdir(spool_root)
+        except OSError:
+            workers = []
+    for worker in workers:
+        directory = os.path.join(spool_root, worker)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(directory, name)
+            pid = name.split('-', 1)[0]
+            if pid.isdigit() and not process_alive(int(pid)):
+                # of a recycled pool process
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    merged.load(json.load(f), worker=worker)
+            except (IOError, OSError, ValueError):
+                logger.debug("Skipping spooled metrics %s.", name)
+    return merged
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = collect().render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(address=metrics_address, port=metrics_port):
+    try:
+        server = HTTPServer((address, port), MetricsHandler)
+    except (IOError, OSError) as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        logger.info("Metrics port %s is served by another worker.", port)
+        return None
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on %s:%s.", address, port)
+    return server
+
+
+def write_textfiles(worker):
+    path = os.path.join(metrics_textfile_dir,
+                        'storagedriver-%s.prom' % worker)
+    while True:
+        try:
+            write_atomic(path, collect([worker]).render())
+        except (IOError, OSError):
+            logger.warning("Cannot write metrics to %s.", path,
+                           exc_info=True)
+        threading.Event().wait(metrics_interval)
+
+
+def start_exporter(worker):
+    """Start exporting the metrics of worker, if configured. Called in
+    the main process of the worker."""
+    directory = os.path.join(spool_root, worker)
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+    if not enabled:
+        return
+    if metrics_port:
+        serve()
+    if metrics_textfile_dir:
+        thread = threading.Thread(target=write_textfiles, args=(worker, ),
+                                  name='metrics-textfile')
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,249 @@
+""" Pre-created snapshot overlays of hot base images.
+
+    A snapshot of a base with a spare overlay in its pool is served by
+    renaming the overlay to the requested name, so `qemu-img create`
+    is not run on the critical path of booting a VM. Snapshot requests
+    are recorded per base; a background thread keeps the pools of the
+    most requested bases filled to the number of requests expected in
+    the next OVERLAY_POOL_HORIZON seconds, based on the last
+    OVERLAY_POOL_WINDOW seconds, and removes the pools of bases which
+    are no longer requested. Pools live in the datastore's state
+    directory, on the same filesystem, so the rename is atomic.
+"""
+import os
+import json
+import math
+import uuid
+import fcntl
+import errno
+import shutil
+import logging
+import threading
+import subprocess
+from time import time
+
+from config import datastores, getenv_bool, state_directory
+from imageinfo import read_image_info
+from metrics import inc, subprocess_timer
+
+logger = logging.getLogger(__name__)
+
+overlay_pool = getenv_bool("OVERLAY_POOL", "false")
+pool_max = int(os.getenv("OVERLAY_POOL_MAX", 8))
+pool_bases = int(os.getenv("OVERLAY_POOL_BASES", 10))
+pool_window = float(os.getenv("OVERLAY_POOL_WINDOW", 600))
+pool_horizon = float(os.getenv("OVERLAY_POOL_HORIZON", 60))
+pool_interval = float(os.getenv("OVERLAY_POOL_INTERVAL", 5))
+overlay_directory = "overlays"
+
+
+class OverlayPool(object):
+
+    """ The overlay pools of the bases of one datastore. """
+
+    FORMAT = 'qcow2'
+
+    def __init__(self, dir):
+        self.dir = os.path.realpath(dir)
+        self.path = os.path.join(self.dir, state_directory,
+                                 overlay_directory)
+        self.demand_path = os.path.join(self.path, 'demand.json')
+
+    @classmethod
+    def for_dir(cls, dir):
+        """Return the pool of the datastore, or None if disabled."""
+        if not overlay_pool:
+            return None
+        return cls(dir)
+
+    def base_path(self, base_name):
+        return os.path.join(self.dir, base_name)
+
+    def pool_path(self, base_name):
+        return os.path.join(self.path, base_name)
+
+    def overlays(self, base_name):
+        try:
+            names = os.listdir(self.pool_path(base_name))
+        except OSError:
+            return []
+        return [os.path.join(self.pool_path(base_name), name)
+                for name in sorted(names) if name.endswith('.qcow2')]
+
+    def record_demand(self, base_name):
+        """Record a snapshot request of base_name."""
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(self.demand_path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    demand = self.demand()
+                    demand.setdefault(base_name, []).append(time())
+                    tmp_path = '%s.%d.tmp' % (self.demand_path, os.getpid())
+                    with open(tmp_path, 'w') as f:
+                        json.dump(demand, f)
+                    os.rename(tmp_path, self.demand_path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except (IOError, OSError):
+            logger.warning("Cannot record overlay demand of %s.", base_name,
+                           exc_info=True)
+
+    def demand(self):
+        """Return the request times of the bases within the window."""
+        try:
+            with open(self.demand_path) as f:
+                demand = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        since = time() - pool_window
+        return dict((base_name, [t for t in times if t >= since])
+                    for base_name, times in demand.items()
+                    if any(t >= since for t in times))
+
+    def targets(self):
+        """Return the pool size of each of the most requested bases."""
+        demand = self.demand()
+        hot = sorted(demand, key=lambda b: len(demand[b]),
+                     reverse=True)[:pool_bases]
+        return dict((base_name, min(pool_max, int(math.ceil(
+            len(demand[base_name]) * pool_horizon / pool_window))))
+            for base_name in hot)
+
+    def matches(self, overlay, base_info, base_path):
+        info = read_image_info(overlay)
+        return (info is not None and info['format'] == self.FORMAT and
+                info['backing-filename'] == base_path and
+                info['virtual-size'] == base_info['virtual-size'])
+
+    def take(self, base_name, target, format):
+        """ Rename a spare overlay of base_name to target.
+            Return False if there is none.
+        """
+        if format != self.FORMAT:
+            return False
+        self.record_demand(base_name)
+        base_path = os.path.realpath(self.base_path(base_name))
+        base_info = read_image_info(base_path)
+        if base_info is not None:
+            for overlay in self.overlays(base_name):
+                if not self.matches(overlay, base_info, base_path):
+                    continue
+                try:
+                    os.rename(overlay, target)
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        continue  # taken by another process
+                    raise
+                logger.debug("Took overlay %s for %s.", overlay, target)
+                inc('storagedriver_overlay_pool_requests_total',
+                    result='hit')
+                return True
+        inc('storagedriver_overlay_pool_requests_total', result='miss')
+        return False
+
+    def create(self, base_name):
+        """Add an overlay to the pool of base_name."""
+        pool_path = self.pool_path(base_name)
+        if not os.path.isdir(pool_path):
+            os.makedirs(pool_path)
+        name = uuid.uuid4().hex
+        tmp_path = os.path.join(pool_path, name + '.tmp')
+        cmdline = ['qemu-img',
+                   'create',
+                   '-b', os.path.realpath(self.base_path(base_name)),
+                   '-f', self.FORMAT,
+                   tmp_path]
+        try:
+            with subprocess_timer(cmdline):
+                subprocess.check_output(cmdline, stderr=subprocess.STDOUT)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        # only complete overlays are taken
+        os.rename(tmp_path, os.path.join(pool_path, name + '.qcow2'))
+
+    def clear(self, base_name):
+        """Remove the pool of base_name."""
+        shutil.rmtree(self.pool_path(base_name), ignore_errors=True)
+
+    def fill(self):
+        """Bring the pools to their target sizes, unless another worker
+        is doing it."""
+        if not os.path.isdir(self.path):
+            return
+        with open(os.path.join(self.path, 'fill.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return
+                raise
+            try:
+                self.fill_pools()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def fill_pools(self):
+        targets = self.targets()
+        try:
+            pooled = [name for name in os.listdir(self.path)
+                      if os.path.isdir(self.pool_path(name))]
+        except OSError:
+            pooled = []
+        for base_name in pooled:
+            if base_name not in targets:
+                self.clear(base_name)
+        for base_name, target in targets.items():
+            base_path = os.path.realpath(self.base_path(base_name))
+            base_info = read_image_info(base_path)
+            if base_info is None:  # trashed or not readable
+                self.clear(base_name)
+                continue
+            overlays = []
+            for overlay in self.overlays(base_name):
+                if self.matches(overlay, base_info, base_path):
+                    overlays.append(overlay)
+                else:
+                    os.unlink(overlay)  # the base was replaced
+            for overlay in overlays[target:]:
+                os.unlink(overlay)
+            for i in range(target - len(overlays)):
+                self.create(base_name)
+
+
+class OverlayPoolFiller(threading.Thread):
+
+    """ Keep the overlay pools of datastores filled. """
+
+    def __init__(self, datastores, interval=pool_interval):
+        super(OverlayPoolFiller, self).__init__(name='overlay-pool')
+        self.daemon = True
+        self.datastores = datastores
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            for datastore in self.datastores:
+                try:
+                    OverlayPool(datastore).fill()
+                except Exception:
+                    logger.exception("Filling overlay pools of %s failed.",
+                                     datastore)
+
+    def stop(self):
+        self.stopping.set()
+
+
+def start_overlay_pool_filler():
+    """Start an OverlayPoolFiller if OVERLAY_POOL and DATASTORES are
+    set."""
+    if not overlay_pool or not datastores():
+        return None
+    filler = OverlayPoolFiller(datastores())
+    filler.start()
+    logger.info("Filling overlay pools of %s.", ', '.join(filler.datastores))
+    return filler
@@ -0,0 +1,148 @@
+""" Asynchronous task progress reporting.
+
+    Copy loops only record their position and read an abort flag; the
+    broker round trips (update_state, the parent task's state and
+    is_aborted) are done by a background thread, coalesced to at most
+    one update per time and byte interval.
+"""
+import os
+import logging
+import threading
+from time import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+progress_interval = float(os.getenv("PROGRESS_INTERVAL", 1.0))
+progress_bytes = int(os.getenv("PROGRESS_BYTES", 16 * 1024 * 1024))
+abort_poll_interval = float(os.getenv("ABORT_POLL_INTERVAL", 1.0))
+parent_state_interval = float(os.getenv("PARENT_STATE_INTERVAL", 30.0))
+
+
+class ProgressReporter(object):
+
+    """ Report the progress of task as parent_id's state in the
+        background. Use it as a context manager around the copy loop:
+
+            with ProgressReporter(task, parent_id, total) as progress:
+                ...
+                progress.update(size)
+                if progress.aborted:
+                    raise AbortException()
+    """
+
+    def __init__(self, task, parent_id, total,
+                 interval=progress_interval, min_bytes=progress_bytes,
+                 abort_interval=abort_poll_interval):
+        self.task = task
+        self.parent_id = parent_id
+        self.total = total
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.abort_interval = abort_interval
+        self.size = 0
+        self.done = 0
+        self.extra = {}
+        self.sent_percent = 0
+        self.sent_done = 0
+        self.sent_time = 0
+        self.parent_state = None
+        self.parent_state_time = 0
+        self.updates = 0
+        self.broker_calls = 0
+        self.abort_flag = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def aborted(self):
+        return self.abort_flag.is_set()
+
+    def update(self, size, done=None, **extra):
+        """ Record that size bytes are written, and done (default size)
+            bytes of total are processed. Never blocks on the broker.
+        """
+        with self.lock:
+            self.size = size
+            self.done = size if done is None else done
+            self.extra = extra
+
+    def percent(self, done):
+        if not self.total:
+            return 0
+        return min(100, round(done * 100.0 / self.total))
+
+    def get_parent_state(self):
+        now = time()
+        if (self.parent_state is None or
+                now - self.parent_state_time > parent_state_interval):
+            self.parent_state = self.task.AsyncResult(self.parent_id).state
+            self.broker_calls += 1
+            self.parent_state_time = now
+        return self.parent_state
+
+    def send(self, final=False):
+        """Send the recorded progress if it is due."""
+        with self.lock:
+            size, done, extra = self.size, self.done, self.extra
+        percent = self.percent(done)
+        if percent <= self.sent_percent:
+            return
+        if not final and (time() - self.sent_time < self.interval or
+                          done - self.sent_done < self.min_bytes):
+            return
+        meta = {'size': size, 'percent': percent}
+        meta.update(extra)
+        self.task.update_state(task_id=self.parent_id,
+                               state=self.get_parent_state(), meta=meta)
+        self.updates += 1
+        self.broker_calls += 1
+        self.sent_percent = percent
+        self.sent_done = done
+        self.sent_time = time()
+
+    def poll_abort(self):
+        self.broker_calls += 1
+        if self.task.is_aborted():
+            self.abort_flag.set()
+
+    def run(self):
+        last_poll = 0
+        tick = min(self.interval, self.abort_interval)
+        while not self.stopping.wait(tick):
+            try:
+                if time() - last_poll >= self.abort_interval:
+                    last_poll = time()
+                    self.poll_abort()
+                if not self.aborted:
+                    self.send()
+            except Exception:
+                logger.warning("Progress report of %s failed.",
+                               self.parent_id, exc_info=True)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='progress-%s' % self.parent_id)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, flush=True):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        if flush and not self.aborted:
+            self.send(final=True)
+        task = getattr(self.task, 'name', None) or 'unknown'
+        metrics.inc('storagedriver_progress_updates_total', self.updates,
+                    task=task)
+        metrics.inc('storagedriver_broker_calls_total', self.broker_calls,
+                    task=task)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(flush=exc_type is None)
@@ -0,0 +1,142 @@
+""" Trash reclaimer.
+
+    The trash is read and stat'ed once, and the minimal set of oldest
+    files whose allocated size covers the missing free space is deleted
+    in one batch. Reclaiming starts when free space drops below the low
+    watermark and frees space up to the high watermark. A background
+    thread can keep the configured datastores above their low watermark.
+    Abandoned partial downloads are removed on every run.
+"""
+import os
+import logging
+import threading
+from os import statvfs
+
+from checksum import prune_sidecars
+from config import datastores, state_directory
+from downloader import expire_downloads
+from inventory import scan_dir, trash_directory
+
+logger = logging.getLogger(__name__)
+
+reclaim_low = float(os.getenv("RECLAIM_LOW_WATERMARK", 10))
+reclaim_high = float(os.getenv("RECLAIM_HIGH_WATERMARK", 15))
+reclaim_interval = float(os.getenv("RECLAIM_INTERVAL", 0))
+
+
+def storage_stat(path):
+    ''' Return free disk space avaliable at path in bytes and percent.'''
+    s = statvfs(path)
+    all_space = s.f_bsize * s.f_blocks
+    free_space = s.f_bavail * s.f_frsize
+    free_space_percent = 100.0 * free_space / all_space
+    return {'free_space': free_space,
+            'free_percent': free_space_percent,
+            'all_space': all_space}
+
+
+def freed_size(st):
+    """Bytes freed by unlinking the file of st, none if other links
+    keep its data."""
+    return st.st_blocks * 512 if st.st_nlink <= 1 else 0
+
+
+def select_oldest(entries, needed):
+    """ Return the oldest (name, stat) entries whose freed size covers
+        needed bytes, or all of them if they do not.
+    """
+    selected = []
+    for name, st in sorted(entries, key=lambda e: e[1].st_ctime):
+        if needed <= 0:
+            break
+        selected.append((name, st))
+        needed -= freed_size(st)
+    return selected, needed
+
+
+def remove_trash(trash_path, name):
+    try:
+        os.unlink(os.path.join(trash_path, name))
+    except OSError:
+        logger.warning("Cannot remove %s from trash.", name, exc_info=True)
+        return False
+    logger.info('Image: %s removed.' % name)
+    return True
+
+
+def reclaim(datastore, low=reclaim_low, high=None):
+    """ Free trash until high (default low) percent of datastore is free,
+        if less than low percent is free. Return the freed bytes and
+        the bytes still missing.
+    """
+    high = max(low, high if high is not None else low)
+    expire_downloads(os.path.join(datastore, state_directory))
+    trash_path = os.path.join(datastore, trash_directory)
+    stat = storage_stat(trash_path)
+    logger.info("Free space on datastore: %s" % stat['free_percent'])
+    if stat['free_percent'] >= low:
+        return 0, 0
+    needed = stat['all_space'] * high / 100.0 - stat['free_space']
+    entries = sorted(((name, st) for name, is_dir, st
+                      in scan_dir(trash_path) if not is_dir),
+                     key=lambda e: e[1].st_ctime)
+    selected = select_oldest(entries, needed)[0]
+    freed = 0
+    for name, st in selected:
+        if remove_trash(trash_path, name):
+            freed += freed_size(st)
+    # extents shared by reflinks free less than counted, remove the
+    # next oldest files one by one while still below the low watermark
+    stat = storage_stat(trash_path)
+    for name, st in entries[len(selected):]:
+        if stat['free_percent'] >= low:
+            break
+        if remove_trash(trash_path, name):
+            freed += freed_size(st)
+            stat = storage_stat(trash_path)
+    missing = stat['all_space'] * high / 100.0 - stat['free_space']
+    # sidecars left behind by images removed by other means
+    prune_sidecars(os.path.join(datastore, state_directory),
+                   os.listdir(datastore))
+    logger.info("Reclaimed %d bytes on %s, %d bytes missing.",
+                freed, datastore, max(0, missing))
+    return freed, max(0, missing)
+
+
+class TrashReclaimer(threading.Thread):
+
+    """ Keep free space of datastores above the low watermark. """
+
+    def __init__(self, datastores, low=reclaim_low, high=reclaim_high,
+                 interval=reclaim_interval):
+        super(TrashReclaimer, self).__init__(name='trash-reclaimer')
+        self.daemon = True
+        self.datastores = datastores
+        self.low = low
+        self.high = high
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            for datastore in self.datastores:
+                try:
+                    reclaim(datastore, self.low, self.high)
+                except Exception:
+                    logger.exception("Reclaiming trash of %s failed.",
+                                     datastore)
+
+    def stop(self):
+        self.stopping.set()
+
+
+def start_background_reclaimer():
+    """Start a TrashReclaimer if RECLAIM_INTERVAL and DATASTORES are
+    set."""
+    if reclaim_interval <= 0 or not datastores():
+        return None
+    reclaimer = TrashReclaimer(datastores())
+    reclaimer.start()
+    logger.info("Reclaiming trash of %s every %s seconds.",
+                ', '.join(reclaimer.datastores), reclaim_interval)
+    return reclaimer
@@ -0,0 +1,77 @@
+""" Sparse writes for downloaded images.
+
+    All-zero blocks are skipped with a seek instead of being written, so
+    the runs of zeros common in raw and qcow2 templates become holes.
+    Optionally the file is preallocated with posix_fallocate when its
+    final size is known, to avoid fragmentation; the skipped blocks are
+    then left allocated (reading as zeros) but still cost no I/O.
+"""
+import os
+import logging
+
+from config import getenv_bool
+
+logger = logging.getLogger(__name__)
+
+sparse_downloads = getenv_bool("DOWNLOAD_SPARSE", "true")
+preallocate_downloads = getenv_bool("DOWNLOAD_PREALLOCATE", "false")
+sparse_block_size = int(os.getenv("DOWNLOAD_SPARSE_BLOCK_SIZE", 64 * 1024))
+
+
+def preallocate(f, size):
+    """Allocate size bytes for file object f if the platform can."""
+    fallocate = getattr(os, 'posix_fallocate', None)
+    if fallocate is None or size <= 0:
+        return False
+    try:
+        fallocate(f.fileno(), 0, size)
+        return True
+    except OSError:
+        logger.debug("Cannot preallocate %s bytes.", size, exc_info=True)
+        return False
+
+
+class SparseWriter(object):
+
+    """ Write to file object f, seeking over all-zero blocks.
+        The skipped ranges must already read as zeros, which is true
+        past the end of the file, in holes and in preallocated space.
+    """
+
+    def __init__(self, f, sparse=None, block_size=None):
+        self.f = f
+        self.sparse = sparse_downloads if sparse is None else sparse
+        self.block_size = block_size or sparse_block_size
+        self.zeros = b'\0' * self.block_size
+        self.skipped = 0
+
+    def write(self, data):
+        if not self.sparse:
+            self.f.write(data)
+            return
+        block_size = self.block_size
+        for start in range(0, len(data), block_size):
+            block = data[start:start + block_size]
+            if block == self.zeros[:len(block)]:
+                self.f.seek(len(block), os.SEEK_CUR)
+                self.skipped += len(block)
+            else:
+                self.f.write(block)
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def reset(self):
+        """Drop everything written so far."""
+        self.f.seek(0)
+        self.f.truncate()
+        self.skipped = 0
+
+    def finish(self):
+        """Set the file size to the written length, covering a hole left
+        at the end."""
+        self.f.truncate(self.f.tell())
+        self.f.flush()
@@ -1,8 +1,12 @@
 from celery import Celery
+from celery.signals import (task_postrun, task_prerun, worker_init,
+                            worker_process_init, worker_ready)
 from kombu import Queue, Exchange
 from os import getenv
 from argparse import ArgumentParser
 
+import metrics
+
 
 parser = ArgumentParser()
 parser.add_argument("-n", "--hostname", dest="hostname",
@@ -17,6 +21,8 @@ if HOSTNAME is None:
 
 AMQP_URI = getenv('AMQP_URI')
 
+PRIORITY = HOSTNAME.rpartition('.')[2]
+
 celery = Celery('storagedriver',
                 broker=AMQP_URI,
                 include=['storagedriver'])
@@ -29,3 +35,57 @@ celery.conf.update(
             'storagedriver', type='direct'), routing_key='storagedriver'),
     )
 )
+
+# Worker processes of the queue, e.g. FAST_CONCURRENCY=8 and
+# SLOW_CONCURRENCY=2. A slow worker takes one message at a time, so
+# queued imports are not held by a busy process.
+if getenv('%s_CONCURRENCY' % PRIORITY.upper()):
+    celery.conf.CELERYD_CONCURRENCY = int(
+        getenv('%s_CONCURRENCY' % PRIORITY.upper()))
+if PRIORITY == 'slow':
+    celery.conf.CELERYD_PREFETCH_MULTIPLIER = 1
+# Pool of the queue's worker, e.g. SLOW_POOL=threads (needs threadpool)
+# runs the imports of the slow worker in one process, see downloadengine.
+POOL = getenv('%s_POOL' % PRIORITY.upper())
+if POOL:
+    celery.conf.CELERYD_POOL = POOL
+
+
+@worker_init.connect
+def probe_capabilities(**kwargs):
+    # before the pool processes are forked, so they inherit the results
+    from capabilities import registry
+    from config import datastores
+    registry.probe(datastores())
+
+
+@worker_ready.connect
+def start_background_services(**kwargs):
+    from inventory import prewarm_datastores
+    from overlaypool import start_overlay_pool_filler
+    from reclaim import start_background_reclaimer
+    start_background_reclaimer()
+    start_overlay_pool_filler()
+    prewarm_datastores()
+    metrics.start_exporter(HOSTNAME)
+    if POOL == 'threads':
+        # tasks run in this process, no pool process is started
+        start_process_services()
+
+
+@worker_process_init.connect
+def start_process_services(**kwargs):
+    from inventory import watch_datastores
+    metrics.registry.clear()
+    watch_datastores()
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, **kwargs):
+    metrics.task_started(task_id)
+
+
+@task_postrun.connect
+def record_task_end(task_id=None, task=None, state=None, **kwargs):
+    metrics.task_finished(task_id, task.name, state)
+    metrics.flush(HOSTNAME)
@@ -1,14 +1,24 @@
-from disk import Disk
-from storagecelery import celery
-from os import path, unlink, statvfs, listdir, mkdir
+from batch import run_batch
+from capabilities import filesystem, qemu_img
+from chainindex import ChainIndex
+from checksum import remove_sidecars
+from config import state_directory
+from disk import AbortException, Disk, DiskMetadataCache
+from downloadengine import download_engine
+from iolimits import OPERATIONS, IOSlot, RateLimiter, io_limits
+from overlaypool import OverlayPool
+from inventory import list_files as datastore_files, scan, trash_directory
+from inventorylog import InventoryLog
+from reclaim import reclaim, storage_stat
+from storagecelery import HOSTNAME, celery
+from templatecache import TemplateCache
+from os import path, unlink, mkdir
 from shutil import move
 from celery.contrib.abortable import AbortableTask
 import logging
 
 logger = logging.getLogger(__name__)
 
-trash_directory = "trash"
-
 
 @celery.task()
 def list(dir):
@@ -17,8 +27,7 @@ def list(dir):
 
 @celery.task()
 def list_files(datastore):
-    return [l for l in listdir(datastore) if
-            path.isfile(path.join(datastore, l))]
+    return datastore_files(datastore)
 
 
 @celery.task()
@@ -34,11 +43,25 @@ class download(AbortableTask):
         disk_desc = kwargs['disk']
         url = kwargs['url']
         parent_id = kwargs.get("parent_id", None)
+        checksum_algorithm = kwargs.get("checksum_algorithm", None)
         disk = Disk.deserialize(disk_desc)
-        disk.download(self, url, parent_id)
+
+        def fetch(context):
+            with IOSlot(disk.dir, aborted=context.is_aborted):
+                disk.download(context, url, parent_id, checksum_algorithm)
+            return True
+        if not download_engine().run(self, fetch):
+            raise AbortException()
         return {'size': disk.size,
                 'type': disk.format,
-                'checksum': disk.checksum, }
+                'checksum': disk.get_checksum(checksum_algorithm), }
+
+
+@celery.task()
+def create_batch(disk_descs, workers=None):
+    ''' Create the disks, return a result or error for each of them.'''
+    return run_batch(lambda desc: Disk.deserialize(desc).create(),
+                     disk_descs, workers)
 
 
 @celery.task()
@@ -47,6 +70,13 @@ def delete(json_data):
     disk.delete()
 
 
+@celery.task()
+def delete_batch(disk_descs, workers=None):
+    ''' Delete the disks, return a result or error for each of them.'''
+    return run_batch(lambda desc: Disk.deserialize(desc).delete(),
+                     disk_descs, workers)
+
+
 @celery.task()
 def delete_dump(disk_path):
     if disk_path.endswith(".dump") and path.isfile(disk_path):
@@ -59,6 +89,13 @@ def snapshot(json_data):
     disk.snapshot()
 
 
+@celery.task()
+def snapshot_batch(disk_descs, workers=None):
+    ''' Snapshot the disks, return a result or error for each of them.'''
+    return run_batch(lambda desc: Disk.deserialize(desc).snapshot(),
+                     disk_descs, workers)
+
+
 class merge(AbortableTask):
     time_limit = 18000
 
@@ -68,7 +105,23 @@ class merge(AbortableTask):
         parent_id = kwargs.get("parent_id", None)
         disk = Disk.deserialize(old_json)
         new_disk = Disk.deserialize(new_json)
-        disk.merge(self, new_disk, parent_id=parent_id)
+        with IOSlot(new_disk.dir, aborted=self.is_aborted):
+            disk.merge(self, new_disk, parent_id=parent_id)
+
+
+class export(AbortableTask):
+    time_limit = 18000
+
+    def run(self, **kwargs):
+        disk_desc = kwargs['disk']
+        target = kwargs['target']
+        parent_id = kwargs.get("parent_id", None)
+        compression = kwargs.get("compression", "gzip")
+        disk = Disk.deserialize(disk_desc)
+        with IOSlot(disk.dir, aborted=self.is_aborted):
+            size = disk.export(self, target, compression, parent_id)
+        return {'size': size,
+                'compression': compression, }
 
 
 @celery.task()
@@ -80,44 +133,99 @@ def get(json_data):
 @celery.task()
 def get_storage_stat(path):
     ''' Return free disk space avaliable at path in bytes and percent.'''
-    s = statvfs(path)
-    all_space = s.f_bsize * s.f_blocks
-    free_space = s.f_bavail * s.f_frsize
-    free_space_percent = 100.0 * free_space / all_space
-    return {'free_space': free_space,
-            'free_percent': free_space_percent}
-
-
-@celery.task()
-def get_file_statistics(datastore):
-    disks = [Disk.get(datastore, name).get_desc()
-             for name in listdir(datastore)
-             if not name.endswith(".dump") and
-             not path.isdir(path.join(datastore, name))]
-    dumps = [{'name': name,
-              'size': path.getsize(path.join(datastore, name))}
-             for name in listdir(datastore) if name.endswith(".dump")]
-    trash = [{'name': name,
-              'size': path.getsize(path.join(datastore, trash_directory,
-                                             name))}
-             for name in listdir(path.join(datastore, trash_directory))]
+    stat = storage_stat(path)
+    return {'free_space': stat['free_space'],
+            'free_percent': stat['free_percent']}
+
+
+@celery.task()
+def get_file_statistics(datastore, workers=None):
+    inventory = scan(datastore, workers)
+    ChainIndex.for_dir(datastore, build=False).rebuild(inventory['disks'])
     return {
-        'dumps': dumps,
-        'trash': trash,
-        'disks': disks,
+        'dumps': inventory['dumps'],
+        'trash': inventory['trash'],
+        'disks': [d.get_desc() for d in inventory['disks']],
     }
 
 
+@celery.task()
+def get_inventory(datastore, token=None, cursor=None, limit=None,
+                  workers=None):
+    ''' Return the disks, dumps and trash entries changed since the
+        generation of token, a page at a time; see InventoryLog.changes.
+    '''
+    inventory = scan(datastore, workers)
+    ChainIndex.for_dir(datastore, build=False).rebuild(inventory['disks'])
+    return InventoryLog(datastore).changes(inventory, token, cursor, limit)
+
+
+@celery.task()
+def get_capabilities(datastore=None):
+    ''' Return the probed qemu-img features, and the filesystem features
+        of the datastore if given.'''
+    result = {'qemu_img': qemu_img()}
+    if datastore is not None:
+        result['filesystem'] = filesystem(datastore)
+    return result
+
+
+@celery.task()
+def get_metadata_cache_stats(datastore):
+    ''' Return hit/miss counters of the datastore's metadata cache in
+        the processes of this worker.'''
+    return DiskMetadataCache.for_dir(datastore).stats(HOSTNAME)
+
+
+@celery.task()
+def get_template_cache_stats(datastore):
+    ''' Return hit/miss counters and size of the template cache.'''
+    cache = TemplateCache.for_dir(datastore)
+    return cache.stats() if cache is not None else None
+
+
+@celery.task()
+def get_io_limits(datastore):
+    ''' Return the I/O limits of the datastore, with the rates in effect.'''
+    limits = io_limits(datastore)
+    for operation in OPERATIONS:
+        limits['%s_rate' % operation] = RateLimiter(datastore,
+                                                    operation).rate()
+    return limits
+
+
+@celery.task()
+def set_io_rate(datastore, operation, rate=None):
+    ''' Limit operation ("download" or "merge") on the datastore to rate
+        bytes per second on this host, 0 for no limit. None restores the
+        configured rate. Merges already running with qemu-img -r keep
+        their rate.
+    '''
+    RateLimiter(datastore, operation).set_rate(rate)
+    return get_io_limits(datastore)
+
+
 @celery.task
-def move_to_trash(datastore, disk_name):
+def move_to_trash(datastore, disk_name, force=False):
     ''' Move path to the trash directory.
+        Refuse to move the base of other disks unless force is set.
     '''
+    index = ChainIndex.for_dir(datastore)
+    children = index.get_children(disk_name)
+    if children and not force:
+        raise Exception("Disk %s is the base of %s." %
+                        (disk_name, ', '.join(children)))
     trash_path = path.join(datastore, trash_directory)
     disk_path = path.join(datastore, disk_name)
     if not path.isdir(trash_path):
         mkdir(trash_path)
     # TODO: trash dir configurable?
     move(disk_path, trash_path)
+    remove_sidecars(path.join(datastore, state_directory), disk_name)
+    index.remove(disk_name)
+    pool = OverlayPool.for_dir(datastore)
+    if pool is not None:
+        pool.clear(disk_name)
 
 
 @celery.task
@@ -129,32 +237,31 @@ def recover_from_trash(datastore, disk_name):
     disk_path = path.join(datastore, trash_directory, disk_name)
     # TODO: trash dir configurable?
     move(disk_path, datastore)
+    disk = Disk.get(datastore, disk_name)
+    ChainIndex.for_dir(datastore).add(disk_name, disk.base_name)
     return True
 
 
 @celery.task
-def make_free_space(datastore, percent=10):
+def make_free_space(datastore, percent=10, high_percent=None):
     ''' Check for free space on datastore.
         If free space is less than the given percent
-        removes oldest files to satisfy the given requirement.
+        removes oldest files to satisfy the given requirement,
+        or high_percent if given.
     '''
-    trash_path = path.join(datastore, trash_directory)
-
-    def comp(filename):
-        try:
-            return path.getctime(path.join(trash_path, filename))
-        except OSError:
-            return 0
-
-    files = sorted(listdir(trash_path), key=comp)
-    logger.info("Free space on datastore: %s" %
-                get_storage_stat(trash_path).get('free_percent'))
-    while get_storage_stat(trash_path).get('free_percent') < percent:
-        logger.debug(get_storage_stat(trash_path))
-        try:
-            f = files.pop(0)
-            unlink(path.join(trash_path, f))
-            logger.info('Image: %s removed.' % f)
-        except IndexError:
-            raise Exception("Trash folder is empty.")
+    reclaim(datastore, percent, high_percent)
+    # unlinked files may still share their data with others
+    if storage_stat(datastore)['free_percent'] < percent:
+        raise Exception("Trash folder is empty.")
     return True
+
+
+@celery.task()
+def get_chain(datastore, disk_name):
+    ''' Return the backing chain relations of the named disk.
+    '''
+    index = ChainIndex.for_dir(datastore)
+    return {'ancestors': index.ancestors(disk_name),
+            'children': index.get_children(disk_name),
+            'depth': index.depth(disk_name),
+            'safe_to_trash': index.is_safe_to_trash(disk_name)}
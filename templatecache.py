@@ -0,0 +1,211 @@
+""" Cache of downloaded template images.
+
+    Validated downloads are kept in the datastore's state directory,
+    named by their digest so the same image behind several URLs is
+    stored once. A repeated download of a URL is revalidated with a
+    conditional GET using the ETag and Last-Modified of the cached
+    response; if the server answers 304 the image is cloned from the
+    cache (reflink, sparse copy or, if allowed, hardlink) instead of
+    being fetched again. The least recently used images are evicted
+    above TEMPLATE_CACHE_SIZE bytes; a size of 0 disables the cache.
+"""
+import os
+import json
+import fcntl
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+
+from config import getenv_bool, state_directory
+from copyengine import CopyEngine
+
+logger = logging.getLogger(__name__)
+
+template_cache_size = int(os.getenv("TEMPLATE_CACHE_SIZE", 0))
+# hardlinked disks share their inode with the cached image, so a write
+# to the disk would change the cache too
+template_cache_hardlink = getenv_bool("TEMPLATE_CACHE_HARDLINK", "false")
+template_directory = "templates"
+
+
+def conditional_headers(entry):
+    """Return the request headers revalidating a cached response."""
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last-modified'):
+            headers['If-Modified-Since'] = entry['last-modified']
+    return headers
+
+
+def allocated_size(path):
+    return os.stat(path).st_blocks * 512
+
+
+class TemplateCache(object):
+
+    """ The template cache of one datastore. The index maps URLs to
+        their validators and cached image, and images to their size and
+        last use; it is changed under a file lock after reloading it.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dir, max_size=template_cache_size):
+        self.dir = os.path.realpath(dir)
+        self.path = os.path.join(self.dir, state_directory,
+                                 template_directory)
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_dir(cls, dir):
+        """Return the cache of the datastore, or None if disabled."""
+        if template_cache_size <= 0:
+            return None
+        dir = os.path.realpath(dir)
+        with cls._instances_lock:
+            cache = cls._instances.get(dir)
+            if cache is None:
+                cache = cls._instances[dir] = cls(dir)
+        return cache
+
+    def blob_path(self, key):
+        return os.path.join(self.path, key)
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            index = {}
+        index.setdefault('urls', {})
+        index.setdefault('blobs', {})
+        index.setdefault('stats', {'hits': 0, 'misses': 0, 'evictions': 0})
+        return index
+
+    @contextmanager
+    def transaction(self):
+        """Yield the index to change under the inter-process lock."""
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(self.index_path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    index = self.load()
+                    yield index
+                    tmp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+                    with open(tmp_path, 'w') as f:
+                        json.dump(index, f)
+                    os.rename(tmp_path, self.index_path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def lookup(self, url):
+        """Return the cached entry of url with its image's path, or None."""
+        index = self.load()
+        entry = index['urls'].get(url)
+        if entry is None or entry['blob'] not in index['blobs']:
+            return None
+        path = self.blob_path(entry['blob'])
+        if not os.path.isfile(path):
+            return None
+        result = dict(index['blobs'][entry['blob']])
+        result.update(entry)
+        result['path'] = path
+        return result
+
+    def clone(self, entry, target, on_progress=None, aborted=None):
+        """ Make target a copy of the cached image of entry.
+            Return the method used, or None if the image is gone.
+        """
+        try:
+            if template_cache_hardlink:
+                try:
+                    os.link(entry['path'], target)
+                    return 'hardlink'
+                except OSError:
+                    logger.debug("Cannot hardlink %s.", entry['path'])
+            method = CopyEngine().copy(entry['path'], target, on_progress,
+                                       aborted)
+        except (IOError, OSError):
+            logger.warning("Cannot copy cached %s.", entry['path'],
+                           exc_info=True)
+            if os.path.exists(target):
+                os.unlink(target)
+            return None
+        with self.transaction() as index:
+            index['stats']['hits'] += 1
+            if entry['blob'] in index['blobs']:
+                index['blobs'][entry['blob']]['used'] = time()
+        return method
+
+    def store(self, url, validators, path, algorithm, digest, format):
+        """Add the downloaded image at path to the cache."""
+        try:
+            self._store(url, validators, path, algorithm, digest, format)
+        except (IOError, OSError):
+            logger.warning("Cannot cache %s.", url, exc_info=True)
+
+    def _store(self, url, validators, path, algorithm, digest, format):
+        key = '%s-%s' % (algorithm, digest)
+        size = allocated_size(path)
+        cacheable = ((validators.get('etag') or
+                      validators.get('last-modified')) and
+                     size <= self.max_size)
+        blob_path = self.blob_path(key)
+        tmp_path = None
+        if cacheable and not os.path.isfile(blob_path):
+            # copy outside of the lock, it may take long
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            tmp_path = '%s.%d.tmp' % (blob_path, os.getpid())
+            CopyEngine().copy(path, tmp_path)
+        with self.transaction() as index:
+            index['stats']['misses'] += 1
+            if not cacheable:
+                index['urls'].pop(url, None)
+                return
+            if tmp_path is not None:
+                os.rename(tmp_path, blob_path)
+            index['blobs'][key] = {'size': size, 'format': format,
+                                   'algorithm': algorithm, 'digest': digest,
+                                   'used': time()}
+            index['urls'][url] = {'etag': validators.get('etag'),
+                                  'last-modified':
+                                      validators.get('last-modified'),
+                                  'blob': key}
+            self.evict(index)
+
+    def evict(self, index):
+        """Remove the least recently used images above max_size."""
+        blobs = index['blobs']
+        total = sum(blob['size'] for blob in blobs.values())
+        for key in sorted(blobs, key=lambda k: blobs[k]['used']):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(self.blob_path(key))
+            except OSError:
+                pass
+            total -= blobs.pop(key)['size']
+            index['stats']['evictions'] += 1
+            for url in [u for u, e in index['urls'].items()
+                        if e['blob'] == key]:
+                del index['urls'][url]
+
+    def stats(self):
+        index = self.load()
+        stats = dict(index['stats'])
+        stats.update({
+            'images': len(index['blobs']),
+            'urls': len(index['urls']),
+            'size': sum(b['size'] for b in index['blobs'].values()),
+            'max_size': self.max_size,
+        })
+        return stats
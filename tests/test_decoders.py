@@ -0,0 +1,121 @@
+import io
+import os
+import sys
+import random
+import unittest
+import zipfile
+
+from decoders import RESET, DecoderError, ZipMemberDecoder
+
+random.seed(0)
+IMAGE = (b'QFI\xfb' + b'\0' * 70000 +
+         bytes(bytearray(random.getrandbits(8) for i in range(50000))) +
+         # a descriptor signature inside the data of a stored member
+         b'PK\x07\x08' + b'\0' * 40 + b'PK\x03\x04' + b'\1' * 1000)
+ISO = b'CD001' + os.urandom(30000)
+README = b'Read me.\n' * 100
+
+STORED = zipfile.ZIP_STORED
+DEFLATED = zipfile.ZIP_DEFLATED
+BZIP2 = getattr(zipfile, 'ZIP_BZIP2', None)
+# writing to unseekable streams and forcing zip64
+STREAMING = sys.version_info >= (3, 6)
+
+
+class Unseekable(object):
+
+    """ A stream zipfile can only append to, so it writes data
+        descriptors like streaming zip tools.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def flush(self):
+        pass
+
+
+def build_zip(members, compression, streamed=False, zip64=False):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(Unseekable(buf) if streamed else buf, 'w',
+                         compression) as z:
+        for name, data in members:
+            if zip64:
+                with z.open(name, 'w', force_zip64=True) as member:
+                    member.write(data)
+            else:
+                z.writestr(name, data)
+    return buf.getvalue()
+
+
+def extract(archive, chunk_size):
+    decoder = ZipMemberDecoder()
+    out = []
+
+    def apply(blocks):
+        for block in blocks:
+            if block is RESET:
+                del out[:]
+            else:
+                out.append(block)
+    for start in range(0, len(archive), chunk_size):
+        apply(decoder.decode(archive[start:start + chunk_size]))
+    apply(decoder.finish())
+    return b''.join(out)
+
+
+# name, members, compression, streamed, zip64, expected
+CASES = [
+    ('stored', [('disk.img', IMAGE)], STORED, False, False, IMAGE),
+    ('stored, descriptor', [('disk.img', IMAGE)], STORED, True, False,
+     IMAGE),
+    ('deflate', [('disk.img', IMAGE)], DEFLATED, False, False, IMAGE),
+    ('deflate, descriptor', [('disk.img', IMAGE)], DEFLATED, True, False,
+     IMAGE),
+    ('bzip2', [('disk.img', IMAGE)], BZIP2, False, False, IMAGE),
+    ('bzip2, descriptor', [('disk.img', IMAGE)], BZIP2, True, False, IMAGE),
+    ('readme before iso', [('README', README), ('disk.iso', ISO)],
+     DEFLATED, False, False, ISO),
+    ('readme before iso, stored, descriptor',
+     [('README', README), ('disk.iso', ISO)], STORED, True, False, ISO),
+    ('iso before readme', [('disk.iso', ISO), ('README', README)],
+     DEFLATED, True, False, ISO),
+    ('zip64, stored', [('disk.img', IMAGE)], STORED, False, True, IMAGE),
+    ('zip64, stored, descriptor', [('disk.img', IMAGE)], STORED, True, True,
+     IMAGE),
+    ('zip64, deflate, descriptor', [('disk.img', IMAGE)], DEFLATED, True,
+     True, IMAGE),
+]
+
+
+class ZipMemberDecoderTest(unittest.TestCase):
+
+    def test_extract(self):
+        for name, members, compression, streamed, zip64, expected in CASES:
+            if compression is None or (streamed or zip64) and not STREAMING:
+                continue  # not supported by this zipfile
+            archive = build_zip(members, compression, streamed, zip64)
+            for chunk_size in (7, 4096, len(archive)):
+                self.assertEqual(extract(archive, chunk_size), expected,
+                                 "%s in chunks of %d" % (name, chunk_size))
+
+    def test_truncated(self):
+        archive = build_zip([('disk.img', IMAGE)], STORED, STREAMING)
+        for size in (10, 1000, len(IMAGE) // 2, len(archive) - 100):
+            self.assertRaises(DecoderError, extract, archive[:size], 4096)
+
+    def test_no_single_member(self):
+        archive = build_zip([('a.img', IMAGE), ('b.img', IMAGE)], DEFLATED)
+        self.assertRaises(DecoderError, extract, archive, 4096)
+
+    def test_crc_mismatch(self):
+        archive = bytearray(build_zip([('disk.img', IMAGE)], STORED))
+        archive[1000] ^= 0xFF
+        self.assertRaises(DecoderError, extract, bytes(archive), 4096)
+
+
+if __name__ == '__main__':
+    unittest.main()
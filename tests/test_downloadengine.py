@@ -0,0 +1,95 @@
+import threading
+import unittest
+
+import downloadengine
+from downloadengine import DownloadEngine
+
+
+class FakeRequest(object):
+    id = 'task-1'
+
+
+class FakeTask(object):
+
+    """ A task whose request is only known in the thread running it,
+        like the request of a celery task.
+    """
+
+    name = 'download'
+
+    def __init__(self):
+        self.local = threading.local()
+        self.local.request = FakeRequest()
+        self.aborted = set()
+        self.states = []
+
+    @property
+    def request(self):
+        return self.local.request
+
+    def is_aborted(self, task_id=None):
+        return (task_id or self.request.id) in self.aborted
+
+    def update_state(self, task_id=None, state=None, meta=None):
+        self.states.append((task_id or self.request.id, meta))
+
+
+class DownloadEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.interval = downloadengine.abort_poll_interval
+        downloadengine.abort_poll_interval = 0.01
+        self.engine = DownloadEngine(workers=1)
+
+    def tearDown(self):
+        downloadengine.abort_poll_interval = self.interval
+        self.engine.pool.terminate()
+
+    def test_result_and_context(self):
+        task = FakeTask()
+
+        def fetch(context):
+            context.update_state(meta={'percent': 50})
+            return context.request.id, context.is_aborted()
+        self.assertEqual(self.engine.run(task, fetch), ('task-1', False))
+        self.assertEqual(task.states, [('task-1', {'percent': 50})])
+        self.assertEqual(self.engine.pending, 0)
+
+    def test_error(self):
+        def fetch(context):
+            raise ValueError('broken')
+        self.assertRaises(ValueError, self.engine.run, FakeTask(), fetch)
+        self.assertEqual(self.engine.pending, 0)
+
+    def test_aborted_while_queued(self):
+        running = threading.Event()
+        release = threading.Event()
+
+        def hold(context):
+            running.set()
+            release.wait()
+        busy = threading.Thread(
+            target=lambda: self.engine.run(FakeTask(), hold))
+        busy.start()
+        running.wait()
+        task = FakeTask()
+        task.aborted.add('task-1')
+        started = []
+        self.assertEqual(self.engine.run(task, started.append), None)
+        release.set()
+        busy.join()
+        self.assertEqual(self.engine.run(FakeTask(), lambda c: True), True)
+        self.assertEqual(started, [])
+        self.assertEqual(self.engine.pending, 0)
+
+    def test_aborted_while_running(self):
+        task = FakeTask()
+
+        def fetch(context):
+            task.aborted.add('task-1')
+            return context.is_aborted()
+        self.assertEqual(self.engine.run(task, fetch), True)
+
+
+if __name__ == '__main__':
+    unittest.main()
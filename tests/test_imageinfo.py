@@ -0,0 +1,103 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from imageinfo import read_image_info
+
+SIZE = 10 * 1024 ** 3
+
+
+def qcow2_header(version=3, size=SIZE, backing=None, backing_size=None,
+                 incompatible=0):
+    """Return a qcow2 header, with the backing file name after it."""
+    header_length = 104 if version == 3 else 72
+    backing_offset = header_length if backing is not None else 0
+    if backing_size is None:
+        backing_size = len(backing or b'')
+    header = struct.pack('>4sIQIIQIIQQIIQ', b'QFI\xfb', version,
+                         backing_offset, backing_size, 16, size, 0, 1,
+                         0x30000, 0x10000, 1, 0, 0)
+    if version == 3:
+        header += struct.pack('>QQQII', incompatible, 0, 0, 4,
+                              header_length)
+    return header + (backing or b'')
+
+
+# name, file name, content, expected (None: ask qemu-img)
+CASES = [
+    ('qcow2 v2', 'a.qcow2', qcow2_header(2),
+     {'format': 'qcow2', 'virtual-size': SIZE}),
+    ('qcow2 v3', 'a.qcow2', qcow2_header(3),
+     {'format': 'qcow2', 'virtual-size': SIZE}),
+    ('qcow2 v2 with backing file', 'a.qcow2',
+     qcow2_header(2, backing=b'base.qcow2'),
+     {'format': 'qcow2', 'virtual-size': SIZE,
+      'backing-filename': 'base.qcow2'}),
+    ('qcow2 v3 with backing file', 'a.qcow2',
+     qcow2_header(3, backing=b'/datastore/base'),
+     {'format': 'qcow2', 'virtual-size': SIZE,
+      'backing-filename': '/datastore/base'}),
+    ('qcow2 v3 dirty', 'a.qcow2', qcow2_header(3, incompatible=1),
+     {'format': 'qcow2', 'virtual-size': SIZE}),
+    ('qcow2 v3 corrupt', 'a.qcow2', qcow2_header(3, incompatible=2), None),
+    ('qcow2 v3 external data file', 'a.qcow2',
+     qcow2_header(3, incompatible=4), None),
+    ('qcow2 v3 unknown incompatible feature', 'a.qcow2',
+     qcow2_header(3, incompatible=1 << 40), None),
+    ('qcow2 v4', 'a.qcow2', qcow2_header(4), None),
+    ('qcow2 over-long backing name', 'a.qcow2',
+     qcow2_header(3, backing=b'b' * 1024), None),
+    ('qcow2 backing name past the end', 'a.qcow2',
+     qcow2_header(3, backing=b'base', backing_size=100), None),
+    ('qcow2 truncated header', 'a.qcow2', qcow2_header(3)[:20], None),
+    ('raw', 'a.img', b'\0' * 4096 + b'data' * 1024,
+     {'format': 'raw', 'virtual-size': 8192}),
+    ('raw iso', 'a.iso', b'\0' * 32768 + b'\1CD001',
+     {'format': 'raw', 'virtual-size': 32774}),
+    ('raw empty', 'a.img', b'', {'format': 'raw', 'virtual-size': 0}),
+    ('qcow version 1', 'a.img', b'QFI\xfb\0\0\0\1' + b'\0' * 504, None),
+    ('vmdk sparse extent', 'a.img', b'KDMV' + b'\0' * 508, None),
+    ('vmdk descriptor', 'a.img', b'# Disk DescriptorFile\n' + b'\0' * 490,
+     None),
+    ('vhdx', 'a.img', b'vhdxfile' + b'\0' * 504, None),
+    ('luks', 'a.img', b'LUKS\xba\xbe' + b'\0' * 506, None),
+    ('vdi', 'a.img', b'\0' * 0x40 + b'\x7f\x10\xda\xbe' + b'\0' * 444,
+     None),
+    ('dmg', 'a.dmg', b'\0' * 512, None),
+]
+
+
+class ReadImageInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_cases(self):
+        for name, file_name, content, expected in CASES:
+            path = os.path.join(self.dir, file_name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            info = read_image_info(path)
+            if expected is None:
+                self.assertEqual(info, None, name)
+                continue
+            self.assertNotEqual(info, None, name)
+            actual_size = info.pop('actual-size')
+            self.assertEqual(actual_size, os.stat(path).st_blocks * 512,
+                             name)
+            self.assertEqual(info, expected, name)
+
+    def test_not_a_regular_file(self):
+        self.assertEqual(read_image_info(self.dir), None)
+
+    def test_missing(self):
+        self.assertEqual(read_image_info(os.path.join(self.dir, 'x')), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
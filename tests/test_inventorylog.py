@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import inventorylog
+from inventorylog import DISK_FIELDS, InventoryLog
+
+
+class FakeDisk(object):
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def get_desc(self):
+        return {'name': self.name, 'dir': '/datastore', 'format': 'qcow2',
+                'type': 'normal', 'size': self.size, 'actual_size': 1,
+                'base_name': None}
+
+
+def inventory(disks=(), dumps=(), trash=()):
+    return {'disks': [FakeDisk(name, size) for name, size in disks],
+            'dumps': [{'name': name, 'size': size} for name, size in dumps],
+            'trash': [{'name': name, 'size': size} for name, size in trash]}
+
+
+def row(name, size):
+    return [name, 'qcow2', 'normal', size, 1, None]
+
+
+class InventoryLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = InventoryLog(self.dir)
+        self.history = inventorylog.inventory_history
+
+    def tearDown(self):
+        inventorylog.inventory_history = self.history
+        shutil.rmtree(self.dir)
+
+    def walk(self, inv, token=None, limit=2):
+        """Return the pages of a listing from token."""
+        pages = [self.log.changes(inv, token, limit=limit)]
+        while pages[-1]['cursor'] is not None:
+            self.assertEqual(pages[-1]['token'], None)
+            pages.append(self.log.changes(inv, token, pages[-1]['cursor'],
+                                          limit=limit))
+        return pages
+
+    def test_full_walk(self):
+        inv = inventory([('a', 1), ('b', 2), ('c', 3)], [('x.dump', 5)],
+                        [('old', 7)])
+        pages = self.walk(inv)
+        self.assertEqual(len(pages), 3)
+        self.assertEqual([page['reset'] for page in pages],
+                         [True, False, False])
+        self.assertNotEqual(pages[-1]['token'], None)
+        self.assertEqual(pages[0]['disks']['fields'], list(DISK_FIELDS))
+        self.assertEqual(sum((page['disks']['changed'] for page in pages),
+                             []),
+                         [row('a', 1), row('b', 2), row('c', 3)])
+        self.assertEqual(pages[1]['dumps']['changed'], [['x.dump', 5]])
+        self.assertEqual(pages[2]['trash']['changed'], [['old', 7]])
+
+    def test_unchanged(self):
+        inv = inventory([('a', 1)])
+        token = self.walk(inv)[-1]['token']
+        result = self.log.changes(inv, token)
+        self.assertEqual(result['token'], token)
+        self.assertFalse(result['reset'])
+        self.assertEqual(result['disks']['changed'], [])
+        self.assertEqual(result['disks']['removed'], [])
+
+    def test_delta(self):
+        token = self.walk(inventory([('a', 1), ('b', 2)],
+                                    [('x.dump', 5)]))[-1]['token']
+        inv = inventory([('a', 1), ('b', 20), ('d', 4)], (), [('old', 7)])
+        pages = self.walk(inv, token)
+        self.assertFalse(pages[0]['reset'])
+        self.assertNotEqual(pages[-1]['token'], token)
+        self.assertEqual(sum((page['disks']['changed'] for page in pages),
+                             []),
+                         [row('b', 20), row('d', 4)])
+        self.assertEqual(sum((page['dumps']['removed'] for page in pages),
+                             []),
+                         ['x.dump'])
+        self.assertEqual(sum((page['trash']['changed'] for page in pages),
+                             []),
+                         [['old', 7]])
+
+    def test_cursor_of_other_token(self):
+        token = self.walk(inventory([('a', 1)]))[-1]['token']
+        inv = inventory([('a', 2), ('b', 1), ('c', 1)])
+        page = self.log.changes(inv, token, limit=2)
+        self.assertRaises(Exception, self.log.changes, inv, None,
+                          page['cursor'], 2)
+        self.assertRaises(Exception, self.log.changes, inv, 'other.1',
+                          page['cursor'], 2)
+
+    def test_unknown_token(self):
+        inv = inventory([('a', 1)])
+        self.walk(inv)
+        self.assertTrue(self.log.changes(inv, 'other.1')['reset'])
+        self.assertTrue(self.log.changes(inv, 'garbage')['reset'])
+
+    def test_history_truncated(self):
+        inventorylog.inventory_history = 2
+        old_token = self.walk(inventory([('a', 1)]))[-1]['token']
+        token = self.walk(inventory([('a', 2)]), old_token)[-1]['token']
+        inv = inventory([('a', 2), ('b', 1), ('c', 1)])
+        result = self.log.changes(inv, old_token, limit=10)
+        self.assertTrue(result['reset'])
+        self.assertEqual(result['disks']['changed'],
+                         [row('a', 2), row('b', 1), row('c', 1)])
+        # the last generation before the change is still in the log
+        result = self.log.changes(inv, token, limit=10)
+        self.assertFalse(result['reset'])
+        self.assertEqual(result['disks']['changed'],
+                         [row('b', 1), row('c', 1)])
+
+    def test_epoch_lost(self):
+        inv = inventory([('a', 1), ('b', 2), ('c', 3)])
+        token = self.walk(inv)[-1]['token']
+        page = self.log.changes(inventory([('a', 2), ('b', 3), ('c', 4)]),
+                                token, limit=2)
+        os.unlink(self.log.path)
+        result = self.log.changes(inv, token)
+        self.assertTrue(result['reset'])
+        self.assertNotEqual(result['token'], token)
+        self.assertRaises(Exception, self.log.changes, inv, token,
+                          page['cursor'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()